@@ -1,12 +1,42 @@
 import pygame as pg
 import pytmx
+from pytmx.pytmx import decode_gid
+from pytmx.util_pygame import handle_transformation, smart_convert
+import argparse
+import base64
+import contextlib
+import hashlib
 import json
+import math
+import mmap
+import os
+import platform
 import random
+import struct
+import threading
+import time
+import tracemalloc
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from xml.etree import ElementTree
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 pg.init()
 
-pg.mixer.init()
+try:
+    pg.mixer.init()
+except pg.error:
+    print('Audio device not found')
 
+# Логическое разрешение: в нём рисуется мир и интерфейс, окно из RESOLUTIONS получает
+# готовый кадр, растянутый с сохранением пропорций
 SCREEN_WIDTH = 900
 SCREEN_HEIGHT = 600
 RESOLUTIONS = ((250, 250), (400, 300), (500, 350), (600, 400), (750, 480), (900, 600), (1100, 600), (1300, 700), (1500, 800))
@@ -20,20 +50,251 @@ BUTTON_HEIGHT = 80
 ICON_SIZE = 80
 PADDING = 10
 
-FPS = 80
+FPS = 80  # частота отрисовки
+TICK_RATE = 80  # частота шагов симуляции, под неё настроены скорости и гравитация
+MAX_FRAME_SKIP = 5
+INTERPOLATION_LIMIT = 80
+BATCHED_ENEMIES = False  # червей и бомб двигает EnemyEngine, нужен numpy
+ENEMY_SYNC_MARGIN = 200
+BLACK_HOLE_SPEED = 15
+BLACK_HOLE_SPAWN_TICKS = 900 * TICK_RATE // 1000  # появление, 6 кадров по 150 мс, дыра стоит на месте
+ACTIVE_MARGIN = 400  # вокруг камеры, дальше враги и анимации засыпают
+MAX_CATCH_UP_TICKS = TICK_RATE * 5
 TILE_SIZE = 2.5
 
+CHUNK_TILES = 16
+CHUNK_CACHE_SIZE = 24
+# Слои отрисовки снизу вверх, каждый уходит на экран одним вызовом blits
+RENDER_LAYERS = ('background', 'tiles', 'pickups', 'enemies', 'player', 'projectiles', 'hud')
+FAST_BLITS = hasattr(pg.Surface, 'fblits')  # есть в pygame-ce
+STREAM_MARGIN = 800  # вокруг камеры чанки держатся загруженными, не меньше ACTIVE_MARGIN
+STREAM_PREFETCH_TICKS = 40  # на сколько тиков движения камеры вперёд подгружаем чанки
+# Слои, которые подгружаются по чанкам вокруг камеры. Статичные тайлы хранятся как gid в TileLayer,
+# сущности - спрайтами, при выгрузке они запоминают своё состояние, а собранные и убитые больше не появляются
+TILE_LAYERS = ('level', 'ghosts', 'spikes')  # в порядке отрисовки
+STREAMED_ENTITIES = ('portals', 'checkpoints', 'coins', 'bombs', 'worms')
+ASSET_CACHE_SIZE = 256
+TEXT_CACHE_SIZE = 128
+
+SAVE_FILE = 'save.json'
+LEVEL_FILE = 'Tiled Projects/level.tmx'
+
+LOADER_WORKERS = 4
+LOADING_FPS = 60
+# Всё, что грузится с диска при старте, кроме тайлсетов уровня - их читает read_level
+PRELOAD_IMAGES = (
+    'Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Background_1.png',
+    'Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Idle_(32 x 32).png',
+    'Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Running_(32 x 32).png',
+    'Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Jumping_(32 x 32).png',
+    'resourses/images/heart/heart.png',
+    'resourses/images/fireball/fireball.png',
+    'resourses/images/bomb/Running_(32 x 32).png',
+    'resourses/images/bomb/2dBOOM.png',
+    'resourses/images/worm/Movement_(32 x 32).png',
+    *(f'resourses/images/black hole/spawn {i + 1}.png' for i in range(6)),
+    'resourses/images/portal/Green Portal Sprite Sheet.png',
+    'resourses/images/flag/Flag.png',
+    'resourses/images/coins/Coin.png',
+    'resourses/images/menu/menu_button.png',
+    'resourses/images/menu/menu.png',
+    'resourses/images/menu/right_button.png',
+    'resourses/images/menu/shop_button.png',
+    'resourses/images/menu/settings_button.png',
+    'resourses/images/menu/jump_bust_button.png',
+    'resourses/images/menu/heart.png',
+    'resourses/images/menu/view_mode_button.png',
+)
+
+# Пределы для --load-report на весь уровень, по слоям: мс, объекты, созданные поверхности, КБ памяти Python.
+# Время меряется с включённым tracemalloc, поэтому оно в несколько раз больше, чем при обычном запуске
+LOAD_BUDGETS = {
+    'load': {'ms': 2000, 'surfaces': 200, 'kb': 4096},
+    'player': {'ms': 20, 'objects': 1, 'surfaces': 60, 'kb': 64},
+    'enemys area': {'ms': 20, 'objects': 100, 'kb': 64},
+    'black holes': {'ms': 20, 'objects': 20, 'surfaces': 20, 'kb': 64},
+    'level': {'ms': 50, 'objects': 6000, 'surfaces': 60, 'kb': 256},
+    'ghosts': {'ms': 50, 'objects': 8000, 'surfaces': 20, 'kb': 256},
+    'spikes': {'ms': 20, 'objects': 1000, 'surfaces': 10, 'kb': 64},
+    'portals': {'ms': 10, 'objects': 5, 'surfaces': 20, 'kb': 32},
+    'checkpoints': {'ms': 10, 'objects': 20, 'surfaces': 10, 'kb': 32},
+    'coins': {'ms': 30, 'objects': 150, 'surfaces': 10, 'kb': 128},
+    'bombs': {'ms': 20, 'objects': 30, 'surfaces': 30, 'kb': 64},
+    'worms': {'ms': 20, 'objects': 30, 'surfaces': 20, 'kb': 64},
+}
+
+# --benchmark: уровень из LEVEL_FILE и он же, повторённый по горизонтали (тайлы и враги вместе)
+BENCHMARK_SCALES = (1, 2, 10, 50)
+BENCHMARK_TICKS = 4000
+BENCHMARK_LEG_TICKS = 100  # столько тиков игрок бежит от одной точки маршрута до переноса на следующую
+BENCHMARK_FRAMES = 60  # на каждое разрешение из RESOLUTIONS
+BENCHMARK_REPEATS = 3  # из повторов берётся лучший
+BENCHMARK_TOLERANCE = 0.15  # на сколько метрика может быть хуже базовой, прежде чем это регрессия
+
+PROFILER_FRAMES = 600  # сколько последних кадров держим для p50/p95/p99
+PROFILER_KEY = pg.K_F3
+
+LEVEL_CACHE_MAGIC = b'BPLV'
+LEVEL_CACHE_VERSION = 3
+
+# Атлас собирает python main.py --build-atlas: все кадры в итоговом размере, вместе с отражёнными
+ATLAS_MANIFEST = 'resourses/atlas/manifest.json'
+ATLAS_VERSION = 1
+ATLAS_PAGE_SIZE = 2048
+
+# Группы, состав которых меняется по ходу игры и откатывается при рестарте
+SNAPSHOT_GROUPS = ('all_sprites', 'coins', 'bombs', 'worms', 'black_holes')
+
+REPLAY_MAGIC = b'BPRP'
+REPLAY_VERSION = 2
+# Клавиши, которые читает Player.update, в записи это биты маски
+REPLAY_KEYS = (pg.K_a, pg.K_d, pg.K_w, pg.K_SPACE, pg.K_LEFT, pg.K_RIGHT, pg.K_z, pg.K_f, pg.K_b, pg.K_c, pg.K_v)
+REPLAY_EVENTS = (pg.KEYDOWN, pg.MOUSEBUTTONDOWN, pg.MOUSEBUTTONUP)
+REPLAY_HEADER = struct.Struct('<4sBIBBB')  # magic, версия, seed, TICK_RATE, разрешение, флаги
+REPLAY_RECORD = struct.Struct('<BHHB')  # тег, число тиков, маска клавиш, число событий
+REPLAY_EVENT = struct.Struct('<Biii')
+REPLAY_END = 1
+
 font = pg.font.Font(None, 40)
 
 
+class AssetRegistry:
+    def __init__(self, max_items=ASSET_CACHE_SIZE):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.atlas = {}  # ключ get_image -> кусок страницы атласа, из кэша не вытесняется
+        self.hits = 0
+        self.misses = 0
+        self.created = 0  # поверхностей, для отчёта о загрузке
+
+    def lookup(self, key):
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+        self.misses += 1
+        return None
+
+    def store(self, key, item):
+        if isinstance(item, pg.Surface):
+            self.created += 1
+        self.items[key] = item
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+        return item
+
+    def get_image(self, path, rect=None, size=None, flip=False):
+        key = (path, rect and tuple(rect), size and (int(size[0]), int(size[1])), flip)
+        if key in self.atlas:
+            self.hits += 1
+            return self.atlas[key]
+        image = self.lookup(key)
+        if image is not None:
+            return image
+
+        if flip:
+            image = pg.transform.flip(self.get_image(path, rect, size), True, False)
+        elif size:
+            image = pg.transform.scale(self.get_image(path, rect), key[2])
+        elif rect:
+            image = self.get_image(path).subsurface(rect)
+        else:
+            image = pg.image.load(path).convert_alpha()
+        return self.store(key, image)
+
+    def get_frames(self, path, frame_width, frame_height, count, size, flip=False):
+        # Кадры идут в спрайтшите слева направо
+        key = (path, (frame_width, frame_height, count), (int(size[0]), int(size[1])), flip)
+        frames = self.lookup(key)
+        if frames is not None:
+            return frames
+
+        frames = [self.get_image(path, (i * frame_width, 0, frame_width, frame_height), size, flip) for i in range(count)]
+        return self.store(key, frames)
+
+    def preload(self, loader, paths):
+        # Декодирование в потоках загрузчика, convert_alpha - в главном
+        for path in paths:
+            loader.submit(pg.image.load, path, then=lambda image, path=path: self.store((path, None, None, False), image.convert_alpha()))
+
+    def preload_atlas(self, loader, manifest, directory):
+        for page, name in enumerate(manifest['pages']):
+            loader.submit(pg.image.load, os.path.join(directory, name), then=lambda image, page=page: self.add_atlas_page(manifest, page, image.convert_alpha()))
+
+    def add_atlas_page(self, manifest, page, image):
+        for path, rect, size, flip, image_page, x, y in manifest['images']:
+            if image_page == page:
+                self.atlas[(path, rect and tuple(rect), tuple(size), flip)] = image.subsurface((x, y, *size))
+                self.created += 1
+
+    def final_images(self):
+        # Картинки в том виде, в каком их рисует игра: промежуточные куски спрайтшитов не нужны
+        images = dict(self.atlas)
+        for key, item in self.items.items():
+            if key[2] is not None and isinstance(item, pg.Surface):
+                images[key] = item
+        return images
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'items': len(self.items), 'atlas': len(self.atlas)}
+
+
+assets = AssetRegistry()
+texts = AssetRegistry(TEXT_CACHE_SIZE)
+
+
 def load_image(file, width, height):
-    image = pg.image.load(file).convert_alpha()
-    image = pg.transform.scale(image, (width, height))
-    return image
+    return assets.get_image(file, size=(width, height))
+
+
+def read_atlas_manifest(path):
+    # None, если атласа нет или он собран из других версий картинок
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != ATLAS_VERSION:
+        return None
+    for source, signature in manifest['sources'].items():
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        if [stat.st_mtime_ns, stat.st_size] != signature:
+            print('Atlas is out of date, rebuild it with --build-atlas')
+            return None
+    for name in manifest['pages']:
+        if not os.path.isfile(os.path.join(os.path.dirname(path), name)):
+            print('Atlas page is missing, rebuild it with --build-atlas')
+            return None
+    return manifest
+
+
+def pack_atlas(images, page_size=ATLAS_PAGE_SIZE):
+    # Полками: картинки от высоких к низким кладутся слева направо, не влезло - следующая полка, потом страница
+    pages = []
+    x = y = shelf = page_size
+    for key, image in sorted(images.items(), key=lambda item: (-item[1].get_height(), -item[1].get_width(), repr(item[0]))):
+        width, height = image.get_size()
+        if x + width > page_size:
+            x, y, shelf = 0, y + shelf, 0
+        if y + height > page_size:
+            pages.append([])
+            x = y = shelf = 0
+        pages[-1].append((key, image, x, y))
+        x += width
+        shelf = max(shelf, height)
+    return pages
 
 
 def text_render(text, color='black'):
-    return font.render(str(text), True, color)
+    # Готовые надписи переиспользуются, рисовать поверх них нельзя
+    key = (str(text), color)
+    image = texts.lookup(key)
+    if image is None:
+        image = texts.store(key, font.render(key[0], True, color))
+    return image
 
 
 def get_gravity(fps=30):
@@ -41,6 +302,530 @@ def get_gravity(fps=30):
     return (30 / (fps / 2)) / fps
 
 
+def file_signature(path):
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).digest()
+    return os.stat(path).st_mtime_ns, digest
+
+
+class Level:
+    # Скомпилированный уровень: то же, что Game.setup берёт из pytmx, но слои хранятся
+    # разреженно (только непустые клетки), а файл читается через mmap без разбора XML
+    def __init__(self, width, height, tilewidth, tileheight, solid, layers, images, rects=None):
+        self.width = width
+        self.height = height
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.solid = solid  # width * height байт, 1 - клетка слоя level занята
+        self.layers = layers  # имя слоя -> {(cx, cy): array('H', [x, y, gid, ...])} по чанкам CHUNK_TILES x CHUNK_TILES
+        self.images = images  # gid -> Surface
+        self.rects = self.merge_solid() if rects is None else rects  # array('H', [x, y, w, h, ...]) в клетках
+
+    @classmethod
+    def from_tmx(cls, tmx_map, layers=None):
+        # layers - уже разобранные слои {имя: [(x, y, gid), ...]}, иначе берём их из pytmx
+        if layers is None:
+            layers = {layer.name: [(x, y, gid) for x, y, gid in layer if gid] for layer in tmx_map.visible_layers if isinstance(layer, pytmx.TiledTileLayer)}
+
+        solid = bytearray(tmx_map.width * tmx_map.height)
+        for x, y, gid in layers.get('level', ()):
+            solid[y * tmx_map.width + x] = 1
+
+        images = {gid: image for gid, image in enumerate(tmx_map.images) if image}
+        chunks = {name: cls.chunked(cells) for name, cells in layers.items()}
+        return cls(tmx_map.width, tmx_map.height, tmx_map.tilewidth, tmx_map.tileheight, bytes(solid), chunks, images)
+
+    def merge_solid(self):
+        # Твёрдые клетки, слитые в прямоугольники: от первой свободной клетки вправо, пока твёрдо,
+        # потом вниз, пока вся полоса твёрдая. Прямоугольники не пересекаются и покрывают ровно solid
+        width = self.width
+        free = bytearray(self.solid)
+        rects = array('H')
+        for y in range(self.height):
+            row = y * width
+            start = free.find(1, row, row + width)
+            while start != -1:
+                end = free.find(0, start, row + width)
+                if end == -1:
+                    end = row + width
+                strip = free[start:end]
+                height = 1
+                while y + height < self.height and free[start + height * width:end + height * width] == strip:
+                    height += 1
+                for i in range(height):
+                    free[start + i * width:end + i * width] = bytes(end - start)
+                rects.extend((start - row, y, end - start, height))
+                start = free.find(1, end, row + width)
+        return rects
+
+    @staticmethod
+    def chunked(cells):
+        chunks = {}
+        for x, y, gid in cells:
+            chunks.setdefault((x // CHUNK_TILES, y // CHUNK_TILES), array('H')).extend((x, y, gid))
+        return chunks
+
+    def repeated(self, copies):
+        # Тот же уровень copies раз подряд по горизонтали, для замеров на больших картах
+        solid = b''.join(self.solid[y * self.width:(y + 1) * self.width] * copies for y in range(self.height))
+        layers = {name: self.chunked((x + i * self.width, y, gid) for i in range(copies) for chunk in chunks for x, y, gid in self.chunk_cells(name, chunk))
+                  for name, chunks in self.layers.items()}
+        return Level(self.width * copies, self.height, self.tilewidth, self.tileheight, solid, layers, self.images)
+
+    def get_layer_by_name(self, name):
+        # Весь слой построчно, как его отдаёт pytmx
+        if name not in self.layers:
+            raise ValueError(f'Layer "{name}" not found')
+        return sorted((cell for chunk in self.layers[name] for cell in self.chunk_cells(name, chunk)), key=lambda cell: (cell[1], cell[0]))
+
+    def chunk_cells(self, name, chunk):
+        data = self.layers.get(name, {}).get(chunk, ())
+        return list(zip(data[0::3], data[1::3], data[2::3]))
+
+    def convert(self):
+        # Тайлы приходят из потока загрузчика несконвертированными, дисплей трогаем только здесь
+        self.images = {gid: smart_convert(image, image.get_colorkey(), True) for gid, image in self.images.items()}
+
+    def get_tile_image_by_gid(self, gid):
+        return self.images.get(gid)
+
+    def save(self, path, dependencies):
+        # dependencies - [(путь, mtime_ns, sha1), ...] исходных файлов уровня
+        chunks = [struct.pack('<4sHH', LEVEL_CACHE_MAGIC, LEVEL_CACHE_VERSION, len(dependencies))]
+        for dependency, mtime, digest in dependencies:
+            name = dependency.encode('utf-8')
+            chunks.append(struct.pack(f'<H{len(name)}sq20s', len(name), name, mtime, digest))
+
+        chunks.append(struct.pack('<4H', self.width, self.height, self.tilewidth, self.tileheight))
+        chunks.append(self.solid)
+        chunks.append(struct.pack(f'<I{len(self.rects)}H', len(self.rects), *self.rects))
+
+        chunks.append(struct.pack('<H', len(self.layers)))
+        for layer_name, layer in self.layers.items():
+            name = layer_name.encode('utf-8')
+            chunks.append(struct.pack(f'<H{len(name)}sI', len(name), name, len(layer)))
+            for (cx, cy), cells in layer.items():
+                chunks.append(struct.pack(f'<3H{len(cells)}H', cx, cy, len(cells), *cells))
+
+        # pytmx отдаёт тайлы и с альфа-каналом, и без него, иногда с colorkey - сохраняем как есть
+        chunks.append(struct.pack('<H', len(self.images)))
+        for gid, image in self.images.items():
+            has_alpha = bool(image.get_flags() & pg.SRCALPHA)
+            colorkey = image.get_colorkey()
+            chunks.append(struct.pack('<3H??3B', gid, *image.get_size(), has_alpha, colorkey is not None, *(colorkey or (0, 0, 0))[:3]))
+            chunks.append(pg.image.tobytes(image, 'RGBA' if has_alpha else 'RGB'))
+
+        # Пишем во временный файл и подменяем, чтобы не оставить недописанный кэш
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(chunks))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        # None, если кэша нет, он повреждён или исходники изменились
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return cls.read(data)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    @classmethod
+    def read(cls, data):
+        offset = 0
+
+        def read(fmt):
+            nonlocal offset
+            values = struct.unpack_from(fmt, data, offset)
+            offset += struct.calcsize(fmt)
+            return values
+
+        magic, version, dependencies_count = read('<4sHH')
+        if magic != LEVEL_CACHE_MAGIC or version != LEVEL_CACHE_VERSION:
+            return None
+
+        for _ in range(dependencies_count):
+            length, = read('<H')
+            name, mtime, digest = read(f'<{length}sq20s')
+            name = name.decode('utf-8')
+            if os.stat(name).st_mtime_ns != mtime and file_signature(name)[1] != digest:
+                return None
+
+        width, height, tilewidth, tileheight = read('<4H')
+        solid = bytes(data[offset:offset + width * height])
+        offset += width * height
+        count, = read('<I')
+        rects = array('H', read(f'<{count}H'))
+
+        layers = {}
+        layers_count, = read('<H')
+        for _ in range(layers_count):
+            length, = read('<H')
+            name, chunks_count = read(f'<{length}sI')
+            layer = layers[name.decode('utf-8')] = {}
+            for _ in range(chunks_count):
+                cx, cy, count = read('<3H')
+                layer[cx, cy] = array('H', read(f'<{count}H'))
+
+        images = {}
+        images_count, = read('<H')
+        for _ in range(images_count):
+            gid, image_width, image_height, has_alpha, has_colorkey, *colorkey = read('<3H??3B')
+            size = image_width * image_height * (4 if has_alpha else 3)
+            image = pg.image.frombytes(bytes(data[offset:offset + size]), (image_width, image_height), 'RGBA' if has_alpha else 'RGB')
+            if has_colorkey:
+                image.set_colorkey(colorkey)
+            images[gid] = image
+            offset += size
+
+        return cls(width, height, tilewidth, tileheight, solid, layers, images, rects)
+
+
+def tile_image_loader(filename, colorkey, **kwargs):
+    # Как pytmx.util_pygame.pygame_image_loader, но без convert, его делает Level.convert в главном потоке
+    image = pg.image.load(filename)
+
+    def load_tile(rect=None, flags=None):
+        tile = image.subsurface(rect) if rect else image.copy()
+        if flags:
+            tile = handle_transformation(tile, flags)
+        if colorkey:
+            tile.set_colorkey(pg.Color(f'#{colorkey}'))
+        return tile
+
+    return load_tile
+
+
+def decode_tile_data(data, node):
+    # node - сам <data> или <chunk> внутри него, кодировка и сжатие указаны у <data>
+    encoding = data.get('encoding')
+    if encoding is None:
+        return [int(tile.get('gid', 0)) for tile in node.findall('tile')]
+    if encoding == 'csv':
+        return [int(value) for value in node.text.split(',') if value.strip()]
+
+    raw = base64.b64decode(node.text.strip())
+    compression = data.get('compression')
+    if compression in ('zlib', 'gzip'):
+        raw = zlib.decompress(raw, 47)  # 47 - zlib сам распознаёт zlib и gzip заголовки
+    elif compression:
+        raise ValueError(f'Tile data compression "{compression}" is not supported')
+    return list(struct.unpack(f'<{len(raw) // 4}I', raw))
+
+
+def load_infinite_tmx(path, image_loader):
+    # pytmx не читает бесконечные карты: слои с чанками разбираем сами, а pytmx отдаём
+    # карту без них, чтобы он загрузил тайлсеты. Карту сдвигаем так, чтобы она начиналась с (0, 0)
+    root = ElementTree.parse(path).getroot()
+    raw_layers = {}
+    bounds = []
+    for node in root.findall('layer'):
+        data = node.find('data')
+        cells = []
+        for chunk in data.findall('chunk'):
+            chunk_x, chunk_y, chunk_width = int(chunk.get('x')), int(chunk.get('y')), int(chunk.get('width'))
+            bounds.append((chunk_x, chunk_y, chunk_x + chunk_width, chunk_y + int(chunk.get('height'))))
+            for i, gid in enumerate(decode_tile_data(data, chunk)):
+                if gid:
+                    cells.append((chunk_x + i % chunk_width, chunk_y + i // chunk_width, gid))
+        if node.get('visible', '1') != '0':
+            raw_layers[node.get('name')] = cells
+        root.remove(node)
+
+    tmx_map = pytmx.TiledMap(image_loader=image_loader)
+    tmx_map.filename = path
+    tmx_map.parse_xml(root)
+
+    # Без флагов pytmx регистрирует тайлы с flags=0, отражённые и повёрнутые получают новые gid
+    gids_count = tmx_map.maxgid
+    layers = {}
+    for name, cells in raw_layers.items():
+        layers[name] = []
+        for x, y, raw_gid in cells:
+            gid, flags = decode_gid(raw_gid)
+            layers[name].append((x, y, tmx_map.register_gid(gid, flags if any(flags) else 0)))
+    if tmx_map.maxgid != gids_count:
+        tmx_map.reload_images()
+
+    # Границы карты - как их показывает Tiled, по всем чанкам
+    bounds = bounds or [(0, 0, 1, 1)]
+    left, top = min(bound[0] for bound in bounds), min(bound[1] for bound in bounds)
+    tmx_map.width = max(bound[2] for bound in bounds) - left
+    tmx_map.height = max(bound[3] for bound in bounds) - top
+    layers = {name: [(x - left, y - top, gid) for x, y, gid in layer] for name, layer in layers.items()}
+    return tmx_map, layers
+
+
+def read_level(path):
+    # Можно вызывать из потока загрузчика. Разбираем TMX только если скомпилированного
+    # уровня нет или он устарел, тогда вместе с уровнем возвращаются исходники для кэша
+    level = Level.load(os.path.splitext(path)[0] + '.cache')
+    if level is not None:
+        return level, None
+
+    if ElementTree.parse(path).getroot().get('infinite') == '1':
+        tmx_map, layers = load_infinite_tmx(path, tile_image_loader)
+    else:
+        tmx_map, layers = pytmx.TiledMap(path, image_loader=tile_image_loader), None
+    level = Level.from_tmx(tmx_map, layers)
+
+    directory = os.path.dirname(path)
+    sources = [path]
+    sources += [os.path.join(directory, node.get('source')) for node in ElementTree.parse(path).getroot().iter('tileset') if node.get('source')]
+    sources += [os.path.join(directory, tileset.source) for tileset in tmx_map.tilesets]
+    return level, sources
+
+
+def save_level_cache(level, path, sources):
+    try:
+        level.save(os.path.splitext(path)[0] + '.cache', [(source, *file_signature(source)) for source in sources])
+    except OSError:
+        print('Level cache not saved')
+
+
+class Loader:
+    # Задачи выполняются в пуле потоков, а их then - в главном потоке из poll(), по порядку добавления
+    def __init__(self, workers=LOADER_WORKERS):
+        self.pool = ThreadPoolExecutor(workers)
+        self.jobs = []
+        self.finished = 0
+
+    def submit(self, func, *args, then=None):
+        self.jobs.append((self.pool.submit(func, *args), then))
+
+    def poll(self, block=False):
+        while self.finished < len(self.jobs):
+            future, then = self.jobs[self.finished]
+            if not block and not future.done():
+                break
+            result = future.result()
+            self.finished += 1
+            if then:
+                then(result)
+        return self.finished == len(self.jobs)
+
+    def progress(self):
+        return self.finished / len(self.jobs) if self.jobs else 1
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class EntityPool:
+    # Переиспользует убитые спрайты вместо создания новых. Свободен тот, кто не состоит
+    # ни в одной группе, поэтому пул не ломается от kill() и отката снимка
+    def __init__(self, factory, limit=None):
+        self.factory = factory
+        self.limit = limit
+        self.sprites = []
+        self.high_water = 0
+
+    def acquire(self, *args, groups=()):
+        live = 0
+        free = None
+        for sprite in self.sprites:
+            if sprite.alive():
+                live += 1
+            elif free is None:
+                free = sprite
+
+        if self.limit is not None and live >= self.limit:
+            return None
+
+        if free is None:
+            free = self.factory(*args)
+            self.sprites.append(free)
+        else:
+            free.reset(*args)
+        free.add(*groups)
+        self.high_water = max(self.high_water, live + 1)
+        return free
+
+    def stats(self):
+        live = sum(1 for sprite in self.sprites if sprite.alive())
+        return {'live': live, 'free': len(self.sprites) - live, 'high_water': self.high_water}
+
+
+class SimulationClock:
+    # Время симуляции считается в тиках, а не по pg.time.get_ticks(), чтобы запись ввода воспроизводилась точно
+    def __init__(self):
+        self.tick = 0
+
+    def get_ticks(self):
+        return self.tick * 1000 // TICK_RATE
+
+
+sim_clock = SimulationClock()
+
+
+class Animation:
+    # Зацикленная анимация, общая для всех спрайтов с теми же кадрами и интервалом
+    def __init__(self, frames, interval):
+        self.frames = frames
+        self.interval = interval
+        self.image = frames[0]
+
+    def update(self, now):
+        self.image = self.frames[now // self.interval % len(self.frames)]
+
+
+class AnimationClock:
+    # Часы анимаций читаются один раз за тик. Кадр цикла считается от общего времени,
+    # поэтому монетам, флагам и порталам не нужны свои таймеры. Одноразовые анимации
+    # (взрыв бомбы, появление чёрной дыры) лежат в таблице спрайт -> (начало, кадры, интервал)
+    def __init__(self):
+        self.now = 0
+        self.loops = {}
+        self.playing = {}
+
+    def tick(self, now):
+        self.now = now
+        for loop in self.loops.values():
+            loop.update(now)
+        for sprite in [sprite for sprite in self.playing if not sprite.alive()]:
+            del self.playing[sprite]
+
+    def reset(self, now, playing=None):
+        # Новый мир или откат к снимку: часы переводятся, одноразовые анимации берутся из снимка
+        self.playing = dict(playing or {})
+        self.tick(now)
+
+    def loop(self, frames, interval):
+        key = (id(frames), interval)
+        if key not in self.loops:
+            self.loops[key] = Animation(frames, interval)
+            self.loops[key].update(self.now)
+        return self.loops[key]
+
+    def index(self, interval, count):
+        return self.now // interval % count
+
+    def play(self, sprite, frames, interval, start=None):
+        self.playing[sprite] = (self.now if start is None else start, frames, interval)
+
+    def frame(self, sprite):
+        # Кадр одноразовой анимации спрайта или None, если она закончилась или не запускалась
+        if sprite not in self.playing:
+            return None
+        start, frames, interval = self.playing[sprite]
+        index = (self.now - start) // interval
+        if index >= len(frames):
+            del self.playing[sprite]
+            return None
+        return frames[index]
+
+    def stop(self, sprite):
+        self.playing.pop(sprite, None)
+
+
+animations = AnimationClock()
+
+
+class KeyState:
+    # Замена pg.key.get_pressed() для заранее записанного ввода
+    def __init__(self, pressed=()):
+        self.pressed = frozenset(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+def get_sprite_state(sprite):
+    # Всё состояние спрайта, кроме ссылок на группы (_Sprite__g и собственные группы вроде fireballs)
+    return {key: value.copy() if isinstance(value, pg.Rect) else value for key, value in vars(sprite).items() if key != '_Sprite__g' and not isinstance(value, pg.sprite.AbstractGroup)}
+
+
+def set_sprite_state(sprite, state):
+    for key, value in state.items():
+        if isinstance(value, pg.Rect):
+            value = value.copy()
+        setattr(sprite, key, value)
+
+
+class ReplayRecorder:
+    # Пишет поток записей: сначала события, потом count тиков с одной и той же маской клавиш
+    def __init__(self, path, seed, resolution, view_mode, batched_enemies):
+        self.file = open(path, 'wb')
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, seed, TICK_RATE, resolution, view_mode | batched_enemies << 1))
+        self.events = []
+        self.mask = 0
+        self.count = 0
+
+    def event(self, event):
+        if event.type not in REPLAY_EVENTS or event.type == pg.KEYDOWN and event.key == PROFILER_KEY:
+            return
+        if self.count:
+            self.flush()
+        if event.type == pg.KEYDOWN:
+            self.events.append(REPLAY_EVENT.pack(0, event.key, 0, 0))
+        else:
+            self.events.append(REPLAY_EVENT.pack(REPLAY_EVENTS.index(event.type), event.pos[0], event.pos[1], event.button))
+
+    def tick(self, keys):
+        mask = sum(1 << i for i, key in enumerate(REPLAY_KEYS) if keys[key])
+        if self.count and (mask != self.mask or self.count == 0xFFFF):
+            self.flush()
+        self.mask = mask
+        self.count += 1
+
+    def flush(self):
+        if self.count or self.events:
+            self.file.write(REPLAY_RECORD.pack(0, self.count, self.mask, len(self.events)) + b''.join(self.events))
+        self.events = []
+        self.count = 0
+
+    def close(self, digest):
+        # В конце хеш итогового состояния, по нему воспроизведение проверяет себя
+        self.flush()
+        self.file.write(bytes((REPLAY_END,)) + digest)
+        self.file.close()
+
+
+class Replay:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        magic, version, self.seed, tick_rate, self.resolution, flags = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f'{path} is not a replay file')
+        if tick_rate != TICK_RATE:
+            raise ValueError(f'{path} was recorded at {tick_rate} ticks per second')
+        self.view_mode = bool(flags & 1)
+        self.batched_enemies = bool(flags & 2)
+
+        self.records = []
+        self.digest = None
+        offset = REPLAY_HEADER.size
+        while offset < len(data):
+            if data[offset] == REPLAY_END:
+                self.digest = data[offset + 1:]
+                break
+            _, count, mask, event_count = REPLAY_RECORD.unpack_from(data, offset)
+            offset += REPLAY_RECORD.size
+
+            events = []
+            for _ in range(event_count):
+                code, a, b, c = REPLAY_EVENT.unpack_from(data, offset)
+                offset += REPLAY_EVENT.size
+                if REPLAY_EVENTS[code] == pg.KEYDOWN:
+                    events.append(pg.event.Event(pg.KEYDOWN, key=a))
+                else:
+                    events.append(pg.event.Event(REPLAY_EVENTS[code], pos=(a, b), button=c))
+
+            keys = KeyState(key for i, key in enumerate(REPLAY_KEYS) if mask >> i & 1)
+            self.records.append((events, count, keys))
+
+    def ticks(self):
+        return sum(count for _, count, _ in self.records)
+
+
+def interpolate(previous, current, alpha):
+    # Телепорты (респаун, переключение камеры) не сглаживаем
+    if abs(current - previous) > INTERPOLATION_LIMIT:
+        return current
+    return previous + (current - previous) * alpha
+
+
 class Player(pg.sprite.Sprite):
     def __init__(self, map_width, map_height):
         super(Player, self).__init__()
@@ -57,6 +842,7 @@ class Player(pg.sprite.Sprite):
 
         self.fireballs_count = 0
         self.fireballs = pg.sprite.Group()
+        self.fireball_pool = EntityPool(Fireball)
 
         self.rect = self.image.get_rect()
         self.spawn = (200, 3000)
@@ -65,7 +851,7 @@ class Player(pg.sprite.Sprite):
         # Начальная скорость и гравитация
         self.velocity_x = 0
         self.velocity_y = 0
-        self.gravity = get_gravity(FPS)
+        self.gravity = get_gravity(TICK_RATE)
         self.friction = 1.2
 
         self.speed = 4
@@ -77,66 +863,42 @@ class Player(pg.sprite.Sprite):
         self.map_height = map_height
 
         self.interval = 100
-        self.timer = pg.time.get_ticks()
+        self.timer = animations.now
 
         self._fly_mode = False
 
-        self.damage_timer = pg.time.get_ticks()
+        self.damage_timer = sim_clock.get_ticks()
         self.damage_interval = 2000
 
     def load_animation(self):
         tile_size, tile_scale = 32, TILE_SIZE / 2
+        size = (tile_size * tile_scale, tile_size * tile_scale)
 
-        self.idle_animation_right = []
-
-        spritesheet = pg.image.load('Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Idle_(32 x 32).png')
-
-        tile_numbers = 5
-        for i in range(tile_numbers):
-            x = i * tile_size
-            y = 0
-            rect = pg.Rect(x, y, tile_size, tile_size)
-            image = spritesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-            self.idle_animation_right.append(image)
-
-        self.idle_animation_left = [pg.transform.flip(image, True, False) for image in self.idle_animation_right]
-
-        self.running_animation_right = []
-
-        spritesheet = pg.image.load('Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Running_(32 x 32).png')
-
-        tile_numbers = 6
-        for i in range(tile_numbers):
-            x = i * tile_size
-            y = 0
-            rect = pg.Rect(x, y, tile_size, tile_size)
-            image = spritesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-            self.running_animation_right.append(image)
+        path = 'Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Idle_(32 x 32).png'
+        self.idle_animation_right = assets.get_frames(path, tile_size, tile_size, 5, size)
+        self.idle_animation_left = assets.get_frames(path, tile_size, tile_size, 5, size, flip=True)
 
-        self.running_animation_left = [pg.transform.flip(image, True, False) for image in self.running_animation_right]
+        path = 'Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Running_(32 x 32).png'
+        self.running_animation_right = assets.get_frames(path, tile_size, tile_size, 6, size)
+        self.running_animation_left = assets.get_frames(path, tile_size, tile_size, 6, size, flip=True)
 
-        image = pg.image.load('Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Jumping_(32 x 32).png')
-        self.jumping_right = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-        self.jumping_left = pg.transform.flip(self.jumping_right, True, False)
+        path = 'Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Jumping_(32 x 32).png'
+        self.jumping_right = assets.get_image(path, size=size)
+        self.jumping_left = assets.get_image(path, size=size, flip=True)
 
     def get_damage(self, damage):
-        if pg.time.get_ticks() - self.damage_timer > self.damage_interval:
+        if sim_clock.get_ticks() - self.damage_timer > self.damage_interval:
             self.hp -= damage
             self.velocity_y = -7
             self.velocity_x  = -10
-            self.damage_timer = pg.time.get_ticks()
+            self.damage_timer = sim_clock.get_ticks()
 
     def attack(self, sprites):
         if self.fireballs_count > 0 :
-            fireball = Fireball(self.rect, True if self.current_animation == self.running_animation_right or self.current_animation == self.idle_animation_right or self.current_animation == self.jumping_right else False)
-            self.fireballs.add(fireball)
-            sprites.add(fireball)
+            self.fireball_pool.acquire(self.rect, True if self.current_animation == self.running_animation_right or self.current_animation == self.idle_animation_right or self.current_animation == self.jumping_right else False, groups=(self.fireballs, sprites))
             self.fireballs_count -= 1
 
-    def update(self, platforms, coins, checkpoints):
-        keys = pg.key.get_pressed()
+    def update(self, collider, coins, checkpoints, keys):
         if keys[pg.K_d]:
             if self.current_animation != self.running_animation_right:
                 self.current_animation = self.running_animation_right
@@ -162,44 +924,34 @@ class Player(pg.sprite.Sprite):
 
         new_x = self.rect.x + self.velocity_x
         if 0 <= new_x and self.map_width - self.rect.width >= new_x:
-            self.rect.x = new_x
-
-        self.velocity_y += self.gravity
-        self.rect.y += self.velocity_y
-
-        for platform in platforms:
-            if platform.rect.collidepoint(self.rect.bottomleft[0] + 10, self.rect.bottomleft[1]) or platform.rect.collidepoint(self.rect.bottomright[0] - 10, self.rect.bottomright[1]):
-                self.velocity_y = 0
-                self.rect.bottom = platform.rect.top
-                if keys[pg.K_w] or keys[pg.K_SPACE]:
-                    if self.current_animation == self.running_animation_right or self.current_animation == self.idle_animation_right:
-                        self.image = self.jumping_right
-                        self.timer = pg.time.get_ticks() + self.interval * 6
-                    else:
-                        self.image = self.jumping_left
-                        self.timer = pg.time.get_ticks() + self.interval * 6
-
-                    self.velocity_y = -self.jump_height * self.gravity
-
-            if platform.rect.collidepoint(self.rect.midtop):
-                self.velocity_y = 0
-                self.rect.top = platform.rect.bottom
-
-            if platform.rect.collidepoint(self.rect.midright):
-                self.velocity_x = 0
-                self.rect.right = platform.rect.left
-            if platform.rect.collidepoint(self.rect.midleft):
+            if collider.sweep_x(self.rect, self.velocity_x):
                 self.velocity_x = 0
-                self.rect.left = platform.rect.right
 
-        for sprite in checkpoints:
+        self.velocity_y += self.gravity
+        if collider.sweep_y(self.rect, self.velocity_y):
+            self.velocity_y = 0
+
+        if self.velocity_y >= 0 and collider.overlaps(self.rect.move(0, 1)):
+            self.velocity_y = 0
+            if keys[pg.K_w] or keys[pg.K_SPACE]:
+                if self.current_animation == self.running_animation_right or self.current_animation == self.idle_animation_right:
+                    self.image = self.jumping_right
+                    self.timer = animations.now + self.interval * 6
+                else:
+                    self.image = self.jumping_left
+                    self.timer = animations.now + self.interval * 6
+
+                self.velocity_y = -self.jump_height * self.gravity
+
+        for sprite in checkpoints.query(self.rect):
             if sprite.rect.collidepoint(self.rect.center):
                 self.spawn = sprite.rect.center
 
-        for sprite in coins:
+        for sprite in coins.query(self.rect):
             if self.rect.collidepoint(sprite.rect.center):
                 self.money += random.randint(5, 15)
                 self.fireballs_count += 1
+                coins.remove(sprite)
                 sprite.kill()
 
         if self.rect.y > self.map_height + 500:
@@ -217,36 +969,39 @@ class Player(pg.sprite.Sprite):
         if keys[pg.K_z] and keys[pg.K_c] and keys[pg.K_v]:
             self.fireballs_count += 1
 
-        if pg.time.get_ticks() - self.timer > self.interval:
+        if animations.now - self.timer > self.interval:
             self.current_image += 1
             if self.current_image >= len(self.current_animation):
                 self.current_image = 0
             self.image = self.current_animation[self.current_image]
-            self.timer = pg.time.get_ticks()
+            self.timer = animations.now
 
 
 class Fireball(pg.sprite.Sprite):
     def __init__(self, player_rect, direction):
         pg.sprite.Sprite.__init__(self)
 
+        self.image = assets.get_image('resourses/images/fireball/fireball.png', size=(30, 30))
+        self.rect = self.image.get_rect()
+        self.interval = 700
+
+        self.reset(player_rect, direction)
+
+    def reset(self, player_rect, direction):
         self.direction = direction
         self.speed = 10 if self.direction else -10
 
-        self.image = pg.image.load('resourses/images/fireball/fireball.png').convert_alpha()
-        self.image = pg.transform.scale(self.image, (30, 30))
-
-        self.timer = pg.time.get_ticks()
-        self.interval = 700
+        self.timer = sim_clock.get_ticks()
 
-        self.rect = self.image.get_rect()
         if self.direction:
             self.rect.center = player_rect.midright
         else:
             self.rect.center = player_rect.midleft
 
-    def update(self):
-        self.rect.x += self.speed
-        if self.timer + self.interval < pg.time.get_ticks():
+    def update(self, collider):
+        if collider.overlaps(self.rect) or collider.sweep_x(self.rect, self.speed):
+            self.kill()
+        if self.timer + self.interval < sim_clock.get_ticks():
             self.kill()
 
 
@@ -268,87 +1023,61 @@ class Bomb(pg.sprite.Sprite):
         # Начальная скорость и гравитация
         self.velocity_x = 0
         self.velocity_y = 0
-        self.gravity = get_gravity(FPS)
+        self.gravity = get_gravity(TICK_RATE)
 
         self.interval = 150
-        self.timer = pg.time.get_ticks()
 
     def load_animation(self):
         tile_size = 32
         tile_scale = TILE_SIZE / 2
+        size = (tile_size * tile_scale, tile_size * tile_scale)
 
-        self.running_animation_left = []
+        path = 'resourses/images/bomb/Running_(32 x 32).png'
+        self.running_animation_left = assets.get_frames(path, tile_size, tile_size, 3, size)
+        self.running_animation_right = assets.get_frames(path, tile_size, tile_size, 3, size, flip=True)
 
-        spritesheet = pg.image.load('resourses/images/bomb/Running_(32 x 32).png')
+        self.boom_animation = assets.get_frames('resourses/images/bomb/2dBOOM.png', 96, 96, 5, size)
 
-        tile_numbers = 3
-        for i in range(tile_numbers):
-            x = i * tile_size
-            y = 0
-            rect = pg.Rect(x, y, tile_size, tile_size)
-            image = spritesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-            self.running_animation_left.append(image)
+    def explode(self):
+        # Игрок может стоять на бомбе несколько тиков, взрыв при этом не перезапускается
+        if self.current_animation is not self.boom_animation:
+            self.current_animation = self.boom_animation
+            animations.play(self, self.boom_animation, self.interval)
 
-        self.running_animation_right = [pg.transform.flip(image, True, False) for image in self.running_animation_left]
-
-        self.boom_animation = []
-
-        spritesheet = pg.image.load('resourses/images/bomb/2dBOOM.png')
-
-        tile_numbers = 5
-        for i in range(tile_numbers):
-            x = i * 96
-            y = 0
-            rect = pg.Rect(x, y, 96, 96)
-            image = spritesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-            self.boom_animation.append(image)
-
-    def update(self, platforms, area):
-        if not self.current_animation == self.boom_animation:
-            if self.direction:
-                self.current_animation = self.running_animation_right
-                self.velocity_x = -3
+    def update(self, collider, area):
+        if self.current_animation == self.boom_animation:
+            # Взрыв доигран (или прервался выгрузкой чанка) - бомбы больше нет
+            image = animations.frame(self)
+            if image is None:
+                self.kill()
             else:
-                self.current_animation = self.running_animation_left
-                self.velocity_x = 3
-
-            new_x = self.rect.x + self.velocity_x
-            self.rect.x = new_x
+                self.image = image
+            return
 
-            self.velocity_y += self.gravity
-            self.rect.y += self.velocity_y
+        if self.direction:
+            self.current_animation = self.running_animation_right
+            self.velocity_x = -3
+        else:
+            self.current_animation = self.running_animation_left
+            self.velocity_x = 3
 
-            for platform in platforms:
-                if platform.rect.collidepoint(self.rect.midright):
-                    self.rect.right = platform.rect.left
-                    self.rect.x += -10
-                    self.direction = True
-                if platform.rect.collidepoint(self.rect.midleft):
-                    self.rect.left = platform.rect.right
-                    self.rect.x += 10
-                    self.direction = False
+        # Упёрлись в стену - разворачиваемся
+        if collider.sweep_x(self.rect, self.velocity_x):
+            self.direction = self.velocity_x > 0
 
-                if platform.rect.collidepoint(self.rect.midbottom):
-                    self.velocity_y = 0
-                    self.rect.bottom = platform.rect.top
+        self.velocity_y += self.gravity
+        if collider.sweep_y(self.rect, self.velocity_y):
+            self.velocity_y = 0
 
-            for block in area:
-                if block.rect.collidepoint(self.rect.midbottom):
-                    self.direction = not self.direction
+        for block in area.query(self.rect):
+            if block.rect.collidepoint(self.rect.midbottom):
+                self.direction = not self.direction
 
-            if self.rect.y > 10000:
-                self.kill()
+        if self.rect.y > 10000:
+            self.kill()
 
-        if pg.time.get_ticks() - self.timer > self.interval:
-            self.current_image += 1
-            if self.current_image >= len(self.current_animation):
-                if self.current_animation == self.boom_animation:
-                    self.kill()
-                self.current_image = 0
-            self.image = self.current_animation[self.current_image]
-            self.timer = pg.time.get_ticks()
+        self.current_image = animations.index(self.interval, len(self.current_animation))
+        self.image = self.current_animation[self.current_image]
 
 
 class Worm(pg.sprite.Sprite):
@@ -369,31 +1098,20 @@ class Worm(pg.sprite.Sprite):
         # Начальная скорость и гравитация
         self.velocity_x = 0
         self.velocity_y = 0
-        self.gravity = get_gravity(FPS)
+        self.gravity = get_gravity(TICK_RATE)
 
         self.interval = 100
-        self.timer = pg.time.get_ticks()
 
     def load_animation(self):
         tile_size = 32
         tile_scale = TILE_SIZE / 2
+        size = (tile_size * tile_scale, tile_size * tile_scale)
 
-        self.running_animation_right = []
-
-        spritesheet = pg.image.load('resourses/images/worm/Movement_(32 x 32).png')
+        path = 'resourses/images/worm/Movement_(32 x 32).png'
+        self.running_animation_right = assets.get_frames(path, tile_size, tile_size, 3, size)
+        self.running_animation_left = assets.get_frames(path, tile_size, tile_size, 3, size, flip=True)
 
-        tile_numbers = 3
-        for i in range(tile_numbers):
-            x = i * tile_size
-            y = 0
-            rect = pg.Rect(x, y, tile_size, tile_size)
-            image = spritesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-            self.running_animation_right.append(image)
-
-        self.running_animation_left = [pg.transform.flip(image, True, False) for image in self.running_animation_right]
-
-    def update(self, platforms, area):
+    def update(self, collider, area):
         if self.direction:
             self.current_animation = self.running_animation_right
             self.velocity_x = -3
@@ -401,126 +1119,242 @@ class Worm(pg.sprite.Sprite):
             self.current_animation = self.running_animation_left
             self.velocity_x = 3
 
-        new_x = self.rect.x + self.velocity_x
-        self.rect.x = new_x
+        if collider.sweep_x(self.rect, self.velocity_x):
+            self.direction = self.velocity_x > 0
 
         self.velocity_y += self.gravity
-        self.rect.y += self.velocity_y
-
-        for platform in platforms:
-            if platform.rect.collidepoint(self.rect.midright):
-                self.rect.right = platform.rect.left
-                self.rect.x += -10
-                self.direction = True
-            if platform.rect.collidepoint(self.rect.midleft):
-                self.rect.left = platform.rect.right
-                self.rect.x += 10
-                self.direction = False
-
-            if platform.rect.collidepoint(self.rect.midbottom):
-                self.velocity_y = 0
-                self.rect.bottom = platform.rect.top
-
-        for block in area:
+        if collider.sweep_y(self.rect, self.velocity_y):
+            self.velocity_y = 0
+
+        for block in area.query(self.rect):
             if block.rect.collidepoint(self.rect.midbottom):
                 self.direction = not self.direction
 
         if self.rect.y > 10000:
             self.kill()
 
-        if pg.time.get_ticks() - self.timer > self.interval:
-            self.current_image += 1
-            if self.current_image >= len(self.current_animation):
-                self.current_image = 0
-            self.image = self.current_animation[self.current_image]
-            self.timer = pg.time.get_ticks()
+        self.current_image = animations.index(self.interval, len(self.current_animation))
+        self.image = self.current_animation[self.current_image]
+
+
+class EnemyEngine:
+    # Червяки и бомбы одним векторным шагом numpy вместо update() у каждого спрайта.
+    # Состояние лежит в массивах, в спрайты оно копируется только рядом с камерой.
+    # Взорвавшиеся бомбы отдаются обратно обычному update()
+    def __init__(self, sprites, level, tile_size):
+        self.tile_size = int(tile_size)
+        self.solid = np.frombuffer(level.solid, dtype=np.uint8).reshape(level.height, level.width).astype(bool)
+        self.area = np.zeros_like(self.solid)
+        try:
+            for x, y, gid in level.get_layer_by_name('enemys area'):
+                self.area[y, x] = True
+        except ValueError:
+            pass
+
+        self.sprites = []
+        self.released = []
+        self.synced = np.zeros(0, dtype=int)
+        for name, values in self.columns(()).items():
+            setattr(self, name, values)
+        self.add(sprites)
+
+    def columns(self, sprites):
+        return {
+            'x': np.array([sprite.rect.x for sprite in sprites], dtype=np.int64),
+            'y': np.array([sprite.rect.y for sprite in sprites], dtype=np.int64),
+            'width': np.array([sprite.rect.width for sprite in sprites], dtype=np.int64),
+            'height': np.array([sprite.rect.height for sprite in sprites], dtype=np.int64),
+            'velocity_x': np.array([sprite.velocity_x for sprite in sprites], dtype=np.int64),
+            'velocity_y': np.array([sprite.velocity_y for sprite in sprites], dtype=np.float64),
+            'gravity': np.array([sprite.gravity for sprite in sprites], dtype=np.float64),
+            'direction': np.array([sprite.direction for sprite in sprites], dtype=bool),
+            'frame': np.array([sprite.current_image for sprite in sprites], dtype=np.int64),
+            'frames_count': np.array([len(sprite.running_animation_right) for sprite in sprites], dtype=np.int64),
+            'interval': np.array([sprite.interval for sprite in sprites], dtype=np.int64),
+        }
+
+    def add(self, sprites):
+        sprites = list(sprites)
+        for name, values in self.columns(sprites).items():
+            setattr(self, name, np.concatenate((getattr(self, name), values)))
+        self.sprites += sprites
+
+    def sync_sprites(self, sprites):
+        sprites = set(sprites)
+        for index, sprite in enumerate(self.sprites):
+            if sprite in sprites:
+                self.sync(index)
+
+    def remove(self, sprites):
+        # Выгружаемые спрайты забирают из массивов своё последнее состояние
+        removed = set(sprites)
+        mask = np.array([sprite not in removed for sprite in self.sprites], dtype=bool)
+        for index in np.flatnonzero(~mask):
+            self.sync(index)
+        self.released = [sprite for sprite in self.released if sprite not in removed]
+        self.keep(mask)
+
+    def keep(self, mask):
+        self.sprites = [sprite for sprite, keep in zip(self.sprites, mask) if keep]
+        for name in ('x', 'y', 'width', 'height', 'velocity_x', 'velocity_y', 'gravity', 'direction', 'frame', 'frames_count', 'interval'):
+            setattr(self, name, getattr(self, name)[mask])
+        # Номера синхронизированных спрайтов сдвигаются вместе с массивами
+        self.synced = (np.cumsum(mask) - 1)[self.synced[mask[self.synced]]]
+
+    def cell_at(self, grid, row, column):
+        inside = (column >= 0) & (column < grid.shape[1]) & (row >= 0) & (row < grid.shape[0])
+        result = np.zeros(len(column), dtype=bool)
+        result[inside] = grid[row[inside], column[inside]]
+        return result
+
+    def grid_at(self, grid, x, y):
+        return self.cell_at(grid, y // self.tile_size, x // self.tile_size)
+
+    def sweep(self, grid, position, length, across, across_length, delta):
+        # Векторный TileCollider.sweep_x/sweep_y, grid индексируется [поперёк, вдоль]
+        size = self.tile_size
+        target = position + delta
+        forward = delta > 0
+        first = np.where(forward, (position + length - 1) // size + 1, position // size - 1)
+        last = np.where(forward, (target + length - 1) // size, target // size)
+        steps = np.where(forward, last - first + 1, np.where(delta < 0, first - last + 1, 0)).clip(min=0)
+        direction = np.where(forward, 1, -1)
+        low, high = across // size, (across + across_length - 1) // size
+
+        hit = np.zeros(len(position), dtype=bool)
+        for step in range(int(steps.max(initial=0))):
+            cell = first + step * direction
+            blocked = np.zeros(len(position), dtype=bool)
+            for offset in range(int((high - low).max(initial=0)) + 1):
+                blocked |= (low + offset <= high) & self.cell_at(grid, low + offset, cell)
+            new_hit = (step < steps) & ~hit & blocked
+            target = np.where(new_hit, np.where(forward, cell * size - length, (cell + 1) * size), target)
+            hit |= new_hit
+        return target, hit
+
+    def step(self, now):
+        self.velocity_x = np.where(self.direction, -3, 3)
+        self.x, hit = self.sweep(self.solid, self.x, self.width, self.y, self.height, self.velocity_x)
+        self.direction = np.where(hit, self.velocity_x > 0, self.direction)
+
+        # Rect округляет дробные координаты вверх с половины
+        self.velocity_y += self.gravity
+        delta = np.floor(self.y + self.velocity_y + 0.5).astype(np.int64) - self.y
+        self.y, hit = self.sweep(self.solid.T, self.y, self.height, self.x, self.width, delta)
+        self.velocity_y[hit] = 0
+
+        self.direction ^= self.grid_at(self.area, self.x + self.width // 2, self.y + self.height)
+
+        self.frame = now // self.interval % self.frames_count
+
+    def sync(self, index):
+        sprite = self.sprites[index]
+        sprite.rect.topleft = int(self.x[index]), int(self.y[index])
+        sprite.velocity_x = int(self.velocity_x[index])
+        sprite.velocity_y = float(self.velocity_y[index])
+        sprite.direction = bool(self.direction[index])
+        sprite.current_animation = sprite.running_animation_right if sprite.direction else sprite.running_animation_left
+        sprite.current_image = int(self.frame[index])
+        sprite.image = sprite.current_animation[sprite.current_image]
+
+    def update(self, collider, area):
+        # Убить, взорвать или выгрузить могли любого, поэтому проверяются все, а не только синхронизированные
+        released = [index for index, sprite in enumerate(self.sprites) if not sprite.alive() or sprite.current_animation is getattr(sprite, 'boom_animation', None)]
+        if released:
+            self.released += [self.sprites[index] for index in released if self.sprites[index].alive()]
+            mask = np.ones(len(self.sprites), dtype=bool)
+            mask[released] = False
+            self.keep(mask)
+
+        self.step(animations.now)
+        self.synced = np.zeros(0, dtype=int)
+
+        fallen = self.y > 10000
+        if fallen.any():
+            for index in np.flatnonzero(fallen):
+                self.sprites[index].kill()
+            self.keep(~fallen)
+
+        for sprite in self.released:
+            sprite.update(collider, area)
+        self.released = [sprite for sprite in self.released if sprite.alive()]
+
+    def sync_near(self, rects):
+        # Спрайты, задевающие rects, получают состояние этого тика, уже синхронизированные не трогаются
+        near = np.zeros(len(self.sprites), dtype=bool)
+        for rect in rects:
+            near |= (self.x < rect.right) & (self.x + self.width > rect.left) & (self.y < rect.bottom) & (self.y + self.height > rect.top)
+        near[self.synced] = False
+        for index in np.flatnonzero(near):
+            self.sync(index)
+        self.synced = np.union1d(self.synced, np.flatnonzero(near))
+
+    def nearby(self, group):
+        # У остальных спрайтов rect остался с того тика, когда их последний раз синхронизировали
+        return pg.sprite.Group([self.sprites[index] for index in self.synced if self.sprites[index] in group], [sprite for sprite in self.released if sprite in group])
+
+
+def black_hole_shift(launch, tick):
+    # Насколько влево улетела к тику tick дыра, появившаяся на тике launch
+    return BLACK_HOLE_SPEED * max(0, tick - launch - BLACK_HOLE_SPAWN_TICKS + 1)
 
 
 class Black_Hole(pg.sprite.Sprite):
-    def __init__(self, spawn):
+    def __init__(self, spawn, launch):
         pg.sprite.Sprite.__init__(self)
 
         self.load_animation()
 
-        self.current_animation = self.spawn_animation
-        self.image = self.current_animation[0]
-        self.current_image = 0
+        self.rect = self.spawn_animation[0].get_rect()
+        self.interval = 150
 
-        self.rect = self.image.get_rect()
-        self.spawn = spawn
-        self.rect.topleft = self.spawn  # Начальное положение
+        self.reset(spawn, launch)
 
-        # Начальная скорость
-        self.velocity_x = 0
+    def reset(self, spawn, launch):
+        self.spawn = spawn
+        self.launch = launch  # тик появления, от него считается положение
 
-        self.interval = 150
-        self.timer = pg.time.get_ticks()
+        # Спрайт может понадобиться посреди полёта, тогда появление уже доиграно
+        self.image = self.spawn_animation[-1]
+        start = launch * 1000 // TICK_RATE
+        if animations.now - start < len(self.spawn_animation) * self.interval:
+            animations.play(self, self.spawn_animation, self.interval, start)
+        self.update()
 
     def load_animation(self):
         tile_size = 32
         tile_scale = TILE_SIZE / 2
 
-        self.spawn_animation = []
-
         tile_numbers = 6
-        for i in range(tile_numbers):
-            self.spawn_animation.append(load_image(f'resourses/images/black hole/spawn {i + 1}.png', tile_size * tile_scale, tile_size * tile_scale))
+        self.spawn_animation = [load_image(f'resourses/images/black hole/spawn {i + 1}.png', tile_size * tile_scale, tile_size * tile_scale) for i in range(tile_numbers)]
 
     def update(self):
-        if self.current_image >= len(self.current_animation):
-            self.velocity_x = -15
+        image = animations.frame(self)
+        if image is not None:
+            self.image = image
 
-        new_x = self.rect.x + self.velocity_x
-        self.rect.x = new_x
-
-        if self.rect.x < -100:
-            self.kill()
-
-        if pg.time.get_ticks() - self.timer > self.interval:
-            self.current_image += 1
-            if not self.current_image >= len(self.current_animation):
-                self.image = self.current_animation[self.current_image]
-                self.timer = pg.time.get_ticks()
+        shift = black_hole_shift(self.launch, sim_clock.tick)
+        self.velocity_x = -BLACK_HOLE_SPEED if shift else 0
+        self.rect.topleft = (self.spawn[0] - shift, self.spawn[1])
 
 
 class Platform(pg.sprite.Sprite):
-    def __init__(self, image, coords, width, height, animated=False, tile_numbers=0, tile_size=1):
+    def __init__(self, image, coords, width, height, tile_numbers, tile_size=1):
         pg.sprite.Sprite.__init__(self)
-        self.animated = animated
-        if self.animated:
-            self.load_animation(image, tile_numbers, width, height, tile_size)
-            self.image = self.animation[0]
-            self.current_image = 0
-            self.timer = pg.time.get_ticks()
-            self.interval = 300
-        else:
-            self.image = pg.transform.scale(image, (width * TILE_SIZE, height * TILE_SIZE))
+        self.load_animation(image, tile_numbers, width, height, tile_size)
+        self.loop = animations.loop(self.animation, 300)
         self.mask = pg.mask.from_surface(self.image)
         self.rect = self.image.get_rect()
         self.rect.topleft = coords
 
     def load_animation(self, image, tile_numbers, tile_width, tile_height, tile_size):
-        self.animation = []
-
-        spritesheet = image
+        # image - путь к спрайтшиту
+        self.animation = assets.get_frames(image, tile_width, tile_height, tile_numbers, (tile_width * tile_size, tile_height * tile_size))
 
-        tile_numbers = tile_numbers
-        for i in range(tile_numbers):
-            x = i * tile_width
-            y = 0
-            rect = pg.Rect(x, y, tile_width, tile_height)
-            image = spritesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_width * tile_size, tile_height * tile_size))
-            self.animation.append(image)
-
-    def update(self):
-        if self.animated:
-            if pg.time.get_ticks() - self.timer > self.interval:
-                self.current_image += 1
-                if self.current_image >= len(self.animation):
-                    self.current_image = 0
-                self.image = self.animation[self.current_image]
-                self.timer = pg.time.get_ticks()
+    @property
+    def image(self):
+        # Кадр общего цикла, обновлять каждую монету по отдельности не нужно
+        return self.loop.image
 
 
 class AreaBlock(pg.sprite.Sprite):
@@ -530,6 +1364,649 @@ class AreaBlock(pg.sprite.Sprite):
         self.rect.topleft = coords
 
 
+class SpatialGrid:
+    def __init__(self, cell_size):
+        self.cell_size = int(cell_size)
+        self.cells = {}
+        self.index = {}
+        self.next_index = 0
+
+    def cells_for(self, rect):
+        size = self.cell_size
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield cx, cy
+
+    def add(self, sprite):
+        self.index[sprite] = self.next_index
+        self.next_index += 1
+        for cell in self.cells_for(sprite.rect):
+            self.cells.setdefault(cell, []).append(sprite)
+
+    def remove(self, sprite):
+        if sprite not in self.index:
+            return
+        for cell in self.cells_for(sprite.rect):
+            self.cells[cell].remove(sprite)
+            if not self.cells[cell]:
+                del self.cells[cell]
+        del self.index[sprite]
+
+    def query(self, rect):
+        # Спрайты рядом с rect (включая точки на его границе) в порядке добавления,
+        # как при переборе группы
+        area = rect.inflate(2, 2)
+        size = self.cell_size
+        columns = range(area.left // size, (area.right - 1) // size + 1)
+        rows = range(area.top // size, (area.bottom - 1) // size + 1)
+        found = set()
+        if len(columns) * len(rows) > len(self.cells):
+            # Область больше всех занятых клеток - дешевле пройти по занятым
+            for (column, row), sprites in self.cells.items():
+                if column in columns and row in rows:
+                    found.update(sprites)
+        else:
+            for column in columns:
+                for row in rows:
+                    found.update(self.cells.get((column, row), ()))
+        return sorted(found, key=self.index.__getitem__)
+
+
+class ActivityRegion:
+    # Спрайты вне активной области спят: не обновляются и лежат в грубой сетке,
+    # откуда их достаёт приближение камеры. Проснувшиеся лежат в группе awake,
+    # поэтому kill() убирает их оттуда сам
+    def __init__(self, sprites, cell_size, tick):
+        self.sleeping = SpatialGrid(cell_size)
+        self.sleep_tick = {}
+        self.awake = pg.sprite.Group()
+        for sprite in sprites:
+            self.sleep(sprite, tick)
+
+    def sleep(self, sprite, tick):
+        # tick - первый тик, на котором спрайт не обновляется
+        self.awake.remove(sprite)
+        self.sleeping.add(sprite)
+        self.sleep_tick[sprite] = tick
+
+    def update(self, area, tick, catch_up=None):
+        # catch_up(sprite, ticks) догоняет проснувшийся спрайт на проспанные тики
+        for sprite in self.sleeping.query(area):
+            if area.colliderect(sprite.rect):
+                self.sleeping.remove(sprite)
+                ticks = tick - self.sleep_tick.pop(sprite)
+                if sprite.alive():
+                    self.awake.add(sprite)
+                    if catch_up:
+                        catch_up(sprite, ticks)
+
+        for sprite in self.awake.sprites():
+            if not area.colliderect(sprite.rect):
+                self.sleep(sprite, tick)
+        return self.awake
+
+    def remove(self, sprite, tick):
+        # Возвращает первый тик, на котором спрайт уже не обновлялся, tick - если он не спал
+        self.awake.remove(sprite)
+        self.sleeping.remove(sprite)
+        return self.sleep_tick.pop(sprite, tick)
+
+
+class TileCollider:
+    # Непрерывные столкновения с твёрдыми тайлами: rect сдвигается по оси до первого
+    # тайла на пути, поэтому большая скорость не проскакивает сквозь стены.
+    # Проверяются слитые прямоугольники уровня (Level.rects), разложенные по чанкам. При первом запросе
+    # к чанку его прямоугольники раскладываются в четыре списка, от ближних к дальним при движении вправо,
+    # влево, вниз и вверх, так что collidelist сразу находит ближайший на пути, а рядом лежат их стороны
+    def __init__(self, level, tile_size, chunk_tiles=CHUNK_TILES):
+        self.tile_size = int(tile_size)
+        self.chunk_size = self.tile_size * chunk_tiles
+        size, chunk_size = self.tile_size, self.chunk_size
+        self.rects = {}  # чанк -> прямоугольники, которые в него заходят
+        for i in range(0, len(level.rects), 4):
+            x, y, width, height = level.rects[i:i + 4]
+            rect = pg.Rect(x * size, y * size, width * size, height * size)
+            for cx in range(rect.left // chunk_size, (rect.right - 1) // chunk_size + 1):
+                for cy in range(rect.top // chunk_size, (rect.bottom - 1) // chunk_size + 1):
+                    self.rects.setdefault((cx, cy), []).append(rect)
+        self.chunks = {}
+        self.empty = [((), ())] * 4
+
+    def orders(self, chunk):
+        orders = self.chunks.get(chunk)
+        if orders is None:
+            if chunk not in self.rects:
+                return self.empty
+            orders = self.chunks[chunk] = []
+            for side, reverse in (('left', False), ('right', True), ('top', False), ('bottom', True)):
+                edge = attrgetter(side)
+                rects = sorted(self.rects[chunk], key=edge, reverse=reverse)
+                orders.append((rects, list(map(edge, rects))))
+        return orders
+
+    def nearest(self, area, order):
+        # Сторона ближайшего по ходу движения прямоугольника, который пересекает area, или None.
+        # order: 0 - вправо (его left), 1 - влево (right), 2 - вниз (top), 3 - вверх (bottom)
+        if area.width <= 0 or area.height <= 0:
+            return None
+        size = self.chunk_size
+        left, right = area.left // size, (area.right - 1) // size
+        top, bottom = area.top // size, (area.bottom - 1) // size
+        if left == right and top == bottom:
+            # Обычный случай - area внутри одного чанка
+            orders = self.chunks.get((left, top)) or self.orders((left, top))
+            rects, edges = orders[order]
+            i = area.collidelist(rects)
+            return edges[i] if i != -1 else None
+
+        found = []
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                rects, edges = self.orders((cx, cy))[order]
+                i = area.collidelist(rects)
+                if i != -1:
+                    found.append(edges[i])
+        if not found:
+            return None
+        return max(found) if order % 2 else min(found)
+
+    def overlaps(self, rect):
+        return self.nearest(rect, 0) is not None
+
+    def sweep_x(self, rect, dx):
+        # True, если rect упёрся в тайл; уже пересекаемые тайлы не мешают выбраться
+        size = self.tile_size
+        target = math.floor(rect.x + dx + 0.5)  # как округляет Rect
+        if target > rect.x:
+            start = -(-rect.right // size) * size  # первая клетка целиком правее rect
+            edge = self.nearest(pg.Rect(start, rect.y, target + rect.width - start, rect.height), 0)
+            if edge is not None:
+                rect.right = max(edge, start)
+                return True
+        elif target < rect.x:
+            start, end = target // size * size, rect.left // size * size
+            edge = self.nearest(pg.Rect(start, rect.y, end - start, rect.height), 1)
+            if edge is not None:
+                rect.left = min(edge, end)
+                return True
+        rect.x = target
+        return False
+
+    def sweep_y(self, rect, dy):
+        size = self.tile_size
+        target = math.floor(rect.y + dy + 0.5)
+        if target > rect.y:
+            start = -(-rect.bottom // size) * size
+            edge = self.nearest(pg.Rect(rect.x, start, rect.width, target + rect.height - start), 2)
+            if edge is not None:
+                rect.bottom = max(edge, start)
+                return True
+        elif target < rect.y:
+            start, end = target // size * size, rect.top // size * size
+            edge = self.nearest(pg.Rect(rect.x, start, rect.width, end - start), 3)
+            if edge is not None:
+                rect.top = min(edge, end)
+                return True
+        rect.y = target
+        return False
+
+
+class TileSet:
+    # Одна растянутая картинка на gid для всех клеток уровня
+    def __init__(self, level):
+        self.level = level
+        self.size = (level.tilewidth * TILE_SIZE, level.tileheight * TILE_SIZE)
+        self.images = {}
+
+    def image(self, gid):
+        if gid not in self.images:
+            tile = self.level.get_tile_image_by_gid(gid)
+            self.images[gid] = pg.transform.scale(tile, self.size) if tile else None
+        return self.images[gid]
+
+
+class TileLayer:
+    # Статичный слой без спрайтов: у каждого загруженного чанка массив gid его клеток,
+    # картинки берутся из общего TileSet
+    def __init__(self, tileset, tile_size, chunk_tiles=CHUNK_TILES):
+        self.tileset = tileset
+        self.tile_size = int(tile_size)
+        self.chunk_tiles = chunk_tiles
+        self.chunks = {}
+
+    def add_chunk(self, chunk, cells):
+        size = self.chunk_tiles
+        gids = array('H', bytes(2 * size * size))
+        for x, y, gid in cells:
+            if self.tileset.image(gid):
+                gids[y % size * size + x % size] = gid
+        self.chunks[chunk] = gids
+
+    def remove_chunk(self, chunk):
+        self.chunks.pop(chunk, None)
+
+    def clear(self):
+        self.chunks = {}
+
+    def cells(self, chunk):
+        size = self.chunk_tiles
+        gids = self.chunks.get(chunk, ())
+        return [(chunk[0] * size + i % size, chunk[1] * size + i // size, gid) for i, gid in enumerate(gids) if gid]
+
+    def gid_at(self, x, y):
+        gids = self.chunks.get((x // self.chunk_tiles, y // self.chunk_tiles))
+        return gids[y % self.chunk_tiles * self.chunk_tiles + x % self.chunk_tiles] if gids else 0
+
+    def query(self, rect):
+        # Клетки, чьи тайлы пересекают rect
+        size = self.tile_size
+        hits = []
+        for y in range(rect.top // size, (rect.bottom - 1) // size + 1):
+            for x in range(rect.left // size, (rect.right - 1) // size + 1):
+                gid = self.gid_at(x, y)
+                if gid:
+                    hits.append((x, y, gid))
+        return hits
+
+
+class ChunkRenderer:
+    # Запекает чанки статичных слоёв в одну поверхность и держит последние max_chunks из них
+    def __init__(self, layers, tile_size, chunk_tiles=CHUNK_TILES, max_chunks=CHUNK_CACHE_SIZE):
+        self.layers = layers  # TileLayer в порядке отрисовки
+        self.tile_size = int(tile_size)
+        self.chunk_size = int(tile_size * chunk_tiles)
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+
+    def get_chunk(self, cell):
+        if cell in self.chunks:
+            self.chunks.move_to_end(cell)
+            return self.chunks[cell]
+
+        x, y = cell[0] * self.chunk_size, cell[1] * self.chunk_size
+        chunk = pg.Surface((self.chunk_size, self.chunk_size), pg.SRCALPHA).convert_alpha()
+        for layer in self.layers:
+            for column, row, gid in layer.cells(cell):
+                chunk.blit(layer.tileset.image(gid), (column * self.tile_size - x, row * self.tile_size - y))
+
+        self.chunks[cell] = chunk
+        while len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def draw(self, batch, camera_x, camera_y, width, height):
+        size = self.chunk_size
+        view = pg.Rect(camera_x, camera_y, width, height)
+        for cx in range(view.left // size, (view.right - 1) // size + 1):
+            for cy in range(view.top // size, (view.bottom - 1) // size + 1):
+                if any((cx, cy) in layer.chunks for layer in self.layers):
+                    batch.add(self.get_chunk((cx, cy)), (cx * size - camera_x, cy * size - camera_y))
+
+
+class RenderBatch:
+    # Пары (картинка, позиция) одного слоя отрисовки. Список живёт между кадрами и только
+    # перезаписывается, а на экран уходит одним blits вместо blit на каждый спрайт
+    def __init__(self):
+        self.items = []
+        self.count = 0
+
+    def add(self, image, position):
+        if self.count < len(self.items):
+            self.items[self.count] = (image, position)
+        else:
+            self.items.append((image, position))
+        self.count += 1
+
+    def draw(self, screen):
+        items = self.items if self.count == len(self.items) else self.items[:self.count]
+        if FAST_BLITS:
+            screen.fblits(items)
+        else:
+            screen.blits(items, doreturn=False)
+        self.count = 0
+
+
+class ChunkStreamer:
+    # Держит загруженными чанки уровня вокруг камеры и впереди по ходу её движения.
+    # load(chunk) создаёт спрайты чанка и возвращает их список, unload(chunk, entities) убирает.
+    # Выгружается чанк только когда камера отойдёт от него ещё на чанк, чтобы на границе
+    # одни и те же чанки не загружались каждый тик
+    def __init__(self, chunk_size, columns, rows, load, unload):
+        self.chunk_size = int(chunk_size)
+        self.columns = columns
+        self.rows = rows
+        self.load = load
+        self.unload = unload
+        self.loaded = {}
+        self.spans = None
+        self.loads = 0
+        self.unloads = 0
+
+    def span(self, rect):
+        # Диапазоны столбцов и строк чанков под rect в пределах уровня
+        size = self.chunk_size
+        return (range(max(rect.left // size, 0), min((rect.right - 1) // size + 1, self.columns)),
+                range(max(rect.top // size, 0), min((rect.bottom - 1) // size + 1, self.rows)))
+
+    def chunks_for(self, span):
+        columns, rows = span
+        return {(cx, cy) for cx in columns for cy in rows}
+
+    def chunk_at(self, pos):
+        return (min(max(int(pos[0]) // self.chunk_size, 0), self.columns - 1),
+                min(max(int(pos[1]) // self.chunk_size, 0), self.rows - 1))
+
+    def update(self, view, velocity=(0, 0)):
+        # velocity - сдвиг камеры за тик
+        area = view.inflate(STREAM_MARGIN * 2, STREAM_MARGIN * 2)
+        ahead = area.move(velocity[0] * STREAM_PREFETCH_TICKS, velocity[1] * STREAM_PREFETCH_TICKS)
+        spans = (self.span(area), self.span(ahead), self.span(area.inflate(self.chunk_size * 2, self.chunk_size * 2)))
+        if spans == self.spans:
+            return  # камера не перешла границу чанка
+        self.spans = spans
+
+        wanted = self.chunks_for(spans[0]) | self.chunks_for(spans[1])
+        keep = wanted | self.chunks_for(spans[2])
+        for chunk in sorted(set(self.loaded) - keep):
+            self.unload(chunk, self.loaded.pop(chunk))
+            self.unloads += 1
+        for chunk in sorted(wanted - set(self.loaded)):
+            self.loaded[chunk] = self.load(chunk)
+            self.loads += 1
+
+    def load_all(self):
+        size = self.chunk_size
+        self.update(pg.Rect(0, 0, self.columns * size, self.rows * size))
+
+    def clear(self):
+        self.loaded = {}
+        self.spans = None
+
+    def stats(self):
+        return {'loaded': len(self.loaded), 'sprites': sum(len(entities) for entities in self.loaded.values()), 'loads': self.loads, 'unloads': self.unloads}
+
+
+class ProfileScope:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+
+# Выключенный профайлер отдаёт один и тот же пустой контекст, так что замеры можно не убирать из кода
+NO_SCOPE = contextlib.nullcontext()
+
+
+class FrameProfiler:
+    def __init__(self, frames=PROFILER_FRAMES):
+        self.enabled = False
+        self.frame_times = deque(maxlen=frames)
+        self.phases = {}
+        self.last_phases = {}
+        self.frame = 0
+        self.frame_start = 0
+        self.output = None
+        self.csv = False
+        self.font = pg.font.Font(None, 20)
+
+    def scope(self, name):
+        if not self.enabled:
+            return NO_SCOPE
+        return ProfileScope(self, name)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds * 1000
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.frame_times.clear()
+        self.phases = {}
+        self.last_phases = {}
+        self.frame_start = time.perf_counter()
+
+    def open(self, path):
+        # .csv - строка на каждую фазу кадра, иначе JSONL - строка на кадр
+        self.output = open(path, 'w', encoding='utf-8')
+        self.csv = path.endswith('.csv')
+        if self.csv:
+            self.output.write('frame,phase,ms\n')
+        if not self.enabled:
+            self.toggle()
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+    def begin_frame(self):
+        if self.enabled:
+            self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        ms = (time.perf_counter() - self.frame_start) * 1000
+        self.frame_times.append(ms)
+        self.frame += 1
+
+        if self.output:
+            if self.csv:
+                self.output.write(f'{self.frame},frame,{ms:.3f}\n')
+                for name, phase_ms in self.phases.items():
+                    self.output.write(f'{self.frame},{name},{phase_ms:.3f}\n')
+            else:
+                phases = {name: round(phase_ms, 3) for name, phase_ms in self.phases.items()}
+                self.output.write(json.dumps({'frame': self.frame, 'ms': round(ms, 3), 'phases': phases}) + '\n')
+
+        self.last_phases = self.phases
+        self.phases = {}
+
+    def percentiles(self):
+        times = sorted(self.frame_times)
+        if not times:
+            return {}
+        return {p: times[min(len(times) - 1, len(times) * p // 100)] for p in (50, 95, 99)}
+
+    def stats(self):
+        return {'frames': len(self.frame_times), 'percentiles': {f'p{p}': round(ms, 3) for p, ms in self.percentiles().items()}, 'phases': {name: round(ms, 3) for name, ms in self.last_phases.items()}}
+
+    def draw(self, screen):
+        percentiles = self.percentiles()
+        lines = ['frame ms  ' + '  '.join(f'p{p} {ms:.2f}' for p, ms in percentiles.items())]
+        lines += [f'{name}  {ms:.2f}' for name, ms in self.last_phases.items()]
+        lines.append('assets  ' + '  '.join(f'{key} {value}' for key, value in assets.stats().items()))
+
+        images = [self.font.render(line, True, 'white') for line in lines]
+        width = max(image.get_width() for image in images) + 10
+        height = len(images) * 16 + 10
+        background = pg.Surface((width, height), pg.SRCALPHA)
+        background.fill((0, 0, 0, 160))
+        screen.blit(background, (0, 60))
+        for i, image in enumerate(images):
+            screen.blit(image, (5, 65 + i * 16))
+
+
+class LoadScope:
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.report.measure()
+
+    def __exit__(self, *exc):
+        self.report.add('layers', self.name, self.start)
+
+
+class LoadReport:
+    # Во что обходится загрузка уровня по слоям и по типам сущностей: время, число объектов,
+    # созданные поверхности и прирост памяти по tracemalloc. Выключенный ничего не меряет
+    def __init__(self, surfaces, budgets=LOAD_BUDGETS):
+        self.enabled = False
+        self.surfaces = surfaces  # функция: сколько поверхностей создано с начала работы
+        self.budgets = budgets
+        self.rows = {'layers': {}, 'entities': {}}
+        self.total = None
+
+    def start(self):
+        self.enabled = True
+        tracemalloc.start()
+        self.total = self.measure()
+
+    def finish(self):
+        self.enabled = False
+        self.total = self.delta(self.total)
+        tracemalloc.stop()
+
+    def measure(self):
+        return time.perf_counter(), tracemalloc.get_traced_memory()[0], self.surfaces()
+
+    def delta(self, start):
+        return {'ms': (time.perf_counter() - start[0]) * 1000, 'surfaces': self.surfaces() - start[2],
+                'kb': (tracemalloc.get_traced_memory()[0] - start[1]) / 1024}
+
+    def row(self, kind, name):
+        return self.rows[kind].setdefault(name, {'ms': 0, 'objects': 0, 'surfaces': 0, 'kb': 0})
+
+    def add(self, kind, name, start, objects=0):
+        row = self.row(kind, name)
+        for key, value in self.delta(start).items():
+            row[key] += value
+        row['objects'] += objects
+
+    def scope(self, name):
+        if not self.enabled:
+            return NO_SCOPE
+        return LoadScope(self, name)
+
+    def count(self, name, objects):
+        if self.enabled:
+            self.row('layers', name)['objects'] += objects
+
+    def entity(self, layer, factory, *args, **kwargs):
+        # Создаёт сущность слоя layer и записывает её цену на её тип
+        if not self.enabled:
+            return factory(*args, **kwargs)
+        start = self.measure()
+        sprite = factory(*args, **kwargs)
+        self.add('entities', type(sprite).__name__, start, 1)
+        self.count(layer, 1)
+        return sprite
+
+    def over_budget(self):
+        return [f'{name}: {key} {self.rows["layers"][name][key]:.1f} > {limit}'
+                for name, limits in self.budgets.items() if name in self.rows['layers']
+                for key, limit in limits.items() if self.rows['layers'][name][key] > limit]
+
+    def stats(self):
+        rows = {kind: {name: {key: round(value, 3) for key, value in row.items()} for name, row in rows.items()} for kind, rows in self.rows.items()}
+        return {**rows, 'total': {key: round(value, 3) for key, value in self.total.items()}, 'over_budget': self.over_budget()}
+
+    def table(self):
+        lines = [f'{"":<16}{"ms":>10}{"objects":>10}{"surfaces":>10}{"kb":>10}']
+        for kind, rows in self.rows.items():
+            lines.append(kind)
+            for name, row in rows.items():
+                lines.append(f'  {name:<14}{row["ms"]:>10.2f}{row["objects"]:>10}{row["surfaces"]:>10}{row["kb"]:>10.1f}')
+        total = self.total
+        lines.append(f'{"total":<16}{total["ms"]:>10.2f}{"":>10}{total["surfaces"]:>10}{total["kb"]:>10.1f}')
+        lines += ['over budget: ' + message for message in self.over_budget()]
+        return '\n'.join(lines)
+
+
+class AutoSaver:
+    # Пишет сохранения в фоновом потоке: если игра успела попросить несколько раз, пишется только последнее
+    def __init__(self, path):
+        self.path = path
+        self.pending = None
+        self.writing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def request(self, text):
+        with self.condition:
+            self.pending = text
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                text, self.pending = self.pending, None
+                self.writing = True
+
+            # Временный файл и подмена, чтобы при падении не остался наполовину записанный save.json
+            try:
+                with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as error:
+                print(f'Autosave failed: {error}')
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            while self.pending is not None or self.writing:
+                self.condition.wait()
+
+
+class Hud:
+    # Верхняя полоса интерфейса собирается в одну поверхность и пересобирается,
+    # только когда меняются показанные на ней значения
+    def __init__(self, game):
+        self.game = game
+        self.values = None
+        self.strips = {}  # число сердец -> полоска, их не больше SCREEN_WIDTH // 30 + 1
+        height = max([60] + [button.rect.bottom for button in game.buttons])
+        self.image = pg.Surface((SCREEN_WIDTH, height), pg.SRCALPHA)
+
+    def hearts(self, hp):
+        # Сердца, которые не влезают в экран, всё равно не видны
+        count = max(0, min(hp, SCREEN_WIDTH // 30))
+        if count not in self.strips:
+            strip = pg.Surface((count * 30, 30), pg.SRCALPHA)
+            for i in range(count):
+                strip.blit(self.game.heart, (i * 30, 0))
+            self.strips[count] = strip
+        return self.strips[count]
+
+    def compose(self):
+        player = self.game.player
+        self.image.fill((0, 0, 0, 0))
+
+        for button in self.game.buttons:
+            button.draw(self.image)
+
+        hearts = self.hearts(player.hp)
+        self.image.blit(hearts, (SCREEN_WIDTH - hearts.get_width(), 0))
+
+        self.image.blit(self.game.coin_image, (0, 0))
+        self.image.blit(self.game.bullet_image, (0, 30))
+
+        self.image.blit(text_render(player.money, 'yellow'), (30, 3))
+        self.image.blit(text_render(player.fireballs_count, 'red'), (30, 33))
+
+    def draw(self, batch):
+        player = self.game.player
+        values = (player.hp, player.money, player.fireballs_count)
+        if values != self.values:
+            self.values = values
+            self.compose()
+        batch.add(self.image, (0, 0))
+
+
 class Button:
     def __init__(self, x, y, width=BUTTON_WIDTH, height=BUTTON_HEIGHT, func=None, image = 'resourses/images/menu/menu_button.png'):
         self.image = load_image(image, width, height)
@@ -561,11 +2038,9 @@ class Menu:
         self.menu_page = load_image('resourses/images/menu/menu.png', 400, 400)
 
         self.mode = 'main'
-        self.quit = False
 
-        self.right_button_image = pg.image.load('resourses/images/menu/right_button.png').convert_alpha()
-        self.right_button_image = pg.transform.scale(self.right_button_image, (50, 50))
-        self.left_button_image = pg.transform.flip(self.right_button_image, True, False)
+        self.right_button_image = load_image('resourses/images/menu/right_button.png', 50, 50)
+        self.left_button_image = assets.get_image('resourses/images/menu/right_button.png', size=(50, 50), flip=True)
 
         buy_jump_button = Button(SCREEN_WIDTH // 2 - BUTTON_WIDTH, SCREEN_HEIGHT // 2 + 100 - BUTTON_HEIGHT,  height=int(BUTTON_HEIGHT*2), width=int(BUTTON_WIDTH*2), func=self.buy_jump, image='resourses/images/menu/jump_bust_button.png')
         buy_health_button = Button(SCREEN_WIDTH // 2 - BUTTON_WIDTH, SCREEN_HEIGHT // 2 - 100 - BUTTON_HEIGHT,  height=int(BUTTON_HEIGHT*2), width=int(BUTTON_WIDTH*2), func=self.buy_health, image='resourses/images/menu/heart.png')
@@ -580,7 +2055,7 @@ class Menu:
         view_mode_button = Button(SCREEN_WIDTH // 2 - BUTTON_WIDTH, SCREEN_HEIGHT // 2 - 100 - BUTTON_HEIGHT,  height=int(BUTTON_HEIGHT*2), width=int(BUTTON_WIDTH*2), func=self.view_mode, image='resourses/images/menu/view_mode_button.png')
         left_resolution_button = Button(SCREEN_WIDTH // 2 - BUTTON_WIDTH * 2, SCREEN_HEIGHT // 2 - 50 + BUTTON_HEIGHT,  height=int(BUTTON_HEIGHT), width=int(BUTTON_WIDTH), func=self.previous_resolution, image='resourses/images/menu/right_button.png')
         right_resolutin_button = Button(SCREEN_WIDTH // 2 + BUTTON_WIDTH, SCREEN_HEIGHT // 2 - 50 + BUTTON_HEIGHT,  height=int(BUTTON_HEIGHT), width=int(BUTTON_WIDTH), func=self.next_resolution, image='resourses/images/menu/right_button.png')
-        left_resolution_button.image = pg.transform.flip(left_resolution_button.image, True, False)
+        left_resolution_button.image = assets.get_image('resourses/images/menu/right_button.png', size=(BUTTON_WIDTH, BUTTON_HEIGHT), flip=True)
 
         self.settings_buttons = [view_mode_button, left_resolution_button, right_resolutin_button]
 
@@ -588,11 +2063,13 @@ class Menu:
         if self.game.player.money >= 100:
             self.game.player.jump_height += 5
             self.game.player.money -= 100
+            self.game.autosave()
 
     def buy_health(self):
         if self.game.player.money >= 50:
             self.game.player.hp += 1
             self.game.player.money -= 50
+            self.game.autosave()
 
     def settings_on(self):
         self.mode = 'settings'
@@ -604,16 +2081,10 @@ class Menu:
         self.game.view_mode = not self.game.view_mode
 
     def previous_resolution(self):
-        self.quit = True
-        self.game.resolution -= 1
-        if self.game.resolution < 0:
-            self.game.resolution = len(RESOLUTIONS) - 1
+        self.game.set_resolution((self.game.resolution - 1) % len(RESOLUTIONS))
 
     def next_resolution(self):
-        self.quit = True
-        self.game.resolution += 1
-        if self.game.resolution > len(RESOLUTIONS) - 1:
-            self.game.resolution = 0
+        self.game.set_resolution((self.game.resolution + 1) % len(RESOLUTIONS))
 
     def update(self):
         for button in self.buttons:
@@ -645,30 +2116,48 @@ class Menu:
             text = text_render(f'{RESOLUTIONS[self.game.resolution][0]}X{RESOLUTIONS[self.game.resolution][1]}', 'brown')
             text_rect = text.get_rect()
             text_rect.center = SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 10 + BUTTON_HEIGHT
-            screen.blit(text_render(f'{RESOLUTIONS[self.game.resolution][0]}X{RESOLUTIONS[self.game.resolution][1]}', 'brown'), text_rect)
+            screen.blit(text, text_rect)
 
 
 class Game:
-    def __init__(self):
-        global SCREEN_WIDTH, SCREEN_HEIGHT
-        with open('save.json', encoding='utf-8') as f:
+    def __init__(self, headless=False, batched_enemies=BATCHED_ENEMIES, settings=None, atlas=True, load_report=None):
+        with open(SAVE_FILE, encoding='utf-8') as f:
             data = json.load(f)
             self.data = data
+        if settings:
+            self.data['settings'].update(settings)
+
+        # Без окна: dummy-драйвер всё равно даёт поверхность для convert_alpha
+        self.headless = headless
+        if self.headless:
+            pg.display.quit()
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            pg.display.init()
+        self.input_source = pg.key.get_pressed
+        self.batched_enemies = batched_enemies and np is not None
+        self.profiler = FrameProfiler()
+        self.tileset = None
+        # load_report - путь к JSON отчёта о загрузке, см. report_level
+        self.load_report_path = load_report
+        self.load_report = LoadReport(self.created_surfaces)
+        if load_report:
+            self.load_report.start()
+        self.recorder = None
+        # Запуски без окна (прогоны, воспроизведение записей) сохранения не читают и не пишут
+        self.saver = None if self.headless else AutoSaver(SAVE_FILE)
+        self.atlas = atlas
+
+        self.set_resolution(self.data['settings']['resolution'])
+        self.screen = pg.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+        pg.display.set_caption("Платформер")
+        with self.load_report.scope('load'):
+            self.load()
+            self.load_report.count('load', len(self.tmx_map.images) + len(assets.atlas) + len(assets.items))
 
-        self.resolution = self.data['settings']['resolution']
-        SCREEN_WIDTH = RESOLUTIONS[self.resolution][0]
-        SCREEN_HEIGHT = RESOLUTIONS[self.resolution][1]
-
-        self.screen = pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
         self.bg = load_image('Tiled Projects/tiles/Legacy Adventure Pack - RUINS/Assets/Background_1.png', SCREEN_WIDTH, SCREEN_HEIGHT)
-        self.heart = pg.image.load('resourses/images/heart/heart.png').convert_alpha()
-        self.heart = pg.transform.scale(self.heart, (30, 30))
-
-        self.coin_image = pg.image.load('resourses/images/menu/shop_button.png').convert_alpha()
-        self.coin_image = pg.transform.scale(self.coin_image, (30, 30))
-
-        self.bullet_image = pg.image.load('resourses/images/fireball/fireball.png').convert_alpha()
-        self.bullet_image = pg.transform.scale(self.bullet_image, (30, 30))
+        self.heart = load_image('resourses/images/heart/heart.png', 30, 30)
+        self.coin_image = load_image('resourses/images/menu/shop_button.png', 30, 30)
+        self.bullet_image = load_image('resourses/images/fireball/fireball.png', 30, 30)
 
         self.menu = Menu(self)
 
@@ -676,185 +2165,607 @@ class Game:
 
         button_x = SCREEN_WIDTH - BUTTON_WIDTH - PADDING
         self.buttons = [Button(button_x, PADDING + 30, func=self.menu_on)]
+        self.hud = Hud(self)
+        self.batches = {name: RenderBatch() for name in RENDER_LAYERS}
 
         self.setup()
+        if self.load_report.enabled:
+            self.report_level()
+        self.load_saved_progress()
+
+    def load(self):
+        # Картинки и уровень декодируются в потоках, окно тем временем показывает прогресс
+        loader = Loader()
+        manifest = read_atlas_manifest(ATLAS_MANIFEST) if self.atlas else None
+        if manifest:
+            assets.preload_atlas(loader, manifest, os.path.dirname(ATLAS_MANIFEST))
+        else:
+            assets.preload(loader, PRELOAD_IMAGES)
+        loader.submit(read_level, LEVEL_FILE, then=lambda result: self.level_loaded(loader, *result))
+
+        clock = pg.time.Clock()
+        while not loader.poll(block=self.headless):
+            for event in pg.event.get():
+                if event.type == pg.QUIT:
+                    loader.close()
+                    pg.quit()
+                    quit()
+            self.draw_loading(loader.progress())
+            clock.tick(LOADING_FPS)
+        loader.close()
+
+    def level_loaded(self, loader, level, sources):
+        level.convert()
+        if sources:
+            loader.submit(save_level_cache, level, LEVEL_FILE, sources)
+        self.tmx_map = level
+
+    def draw_loading(self, progress):
+        self.screen.fill('black')
+        bar = pg.Rect(0, 0, SCREEN_WIDTH // 2, 20)
+        bar.center = SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2
+        pg.draw.rect(self.screen, 'white', bar, 2)
+        pg.draw.rect(self.screen, 'white', (bar.x, bar.y, bar.width * progress, bar.height))
+        self.screen.blit(text_render('Loading', 'white'), (bar.x, bar.y - 40))
+        self.present()
+
+    def set_resolution(self, resolution):
+        # Меняется только окно: кадр по-прежнему рисуется в SCREEN_WIDTH x SCREEN_HEIGHT
+        self.resolution = resolution
+        self.window = pg.display.set_mode(RESOLUTIONS[resolution])
+        self.window.fill('black')
+
+        window_width, window_height = self.window.get_size()
+        scale = min(window_width / SCREEN_WIDTH, window_height / SCREEN_HEIGHT)
+        self.view_rect = pg.Rect(0, 0, round(SCREEN_WIDTH * scale), round(SCREEN_HEIGHT * scale))
+        self.view_rect.center = window_width // 2, window_height // 2
+        # Растягиваем сразу в окно, без промежуточной поверхности
+        self.view = self.window.subsurface(self.view_rect)
+
+    def present(self):
+        if self.view_rect.size == self.screen.get_size():
+            self.view.blit(self.screen, (0, 0))
+        else:
+            pg.transform.scale(self.screen, self.view_rect.size, self.view)
+        pg.display.flip()
+
+    def to_screen(self, pos):
+        # Координаты окна -> координаты логического кадра
+        return ((pos[0] - self.view_rect.x) * SCREEN_WIDTH // self.view_rect.width,
+                (pos[1] - self.view_rect.y) * SCREEN_HEIGHT // self.view_rect.height)
 
     def setup(self):
         self.mode = 'game'
-        pg.display.set_caption("Платформер")
         self.clock = pg.time.Clock()
         self.is_running = False
 
-        self.tmx_map = pytmx.load_pygame('Tiled Projects/level.tmx')
-
         self.camera_x = 0
         self.camera_y = 0
+        self.previous_camera = (0, 0)
+        self.previous_positions = {}
+        sim_clock.tick = 0
+        animations.reset(sim_clock.get_ticks())
 
         self.all_sprites = pg.sprite.Group()
-        self.platforms = pg.sprite.Group()
         self.checkpoints = pg.sprite.Group()
         self.portals = pg.sprite.Group()
-        self.spikes = pg.sprite.Group()
         self.coins = pg.sprite.Group()
         self.bombs = pg.sprite.Group()
         self.worms = pg.sprite.Group()
         self.black_holes = pg.sprite.Group()
-        self.black_holes_timer = pg.time.get_ticks()
+        self.black_holes_timer = sim_clock.get_ticks()
         self.black_holes_interval = 3000
         self.area_blocks = pg.sprite.Group()
 
         self.map_width = self.tmx_map.width * self.tmx_map.tilewidth * TILE_SIZE
         self.map_height = self.tmx_map.height * self.tmx_map.tileheight * TILE_SIZE
 
-        self.player = Player(self.map_width, self.map_height)
+        cell_size = self.tmx_map.tilewidth * TILE_SIZE
+        self.collider = TileCollider(self.tmx_map, cell_size)
+        self.area_grid = SpatialGrid(cell_size)
+
+        report = self.load_report
+        with report.scope('player'):
+            self.player = report.entity('player', Player, self.map_width, self.map_height)
         self.all_sprites.add(self.player)
         self.player.money = 0
 
-        for x, y, gid in self.tmx_map.get_layer_by_name('level'):
-            tile = self.tmx_map.get_tile_image_by_gid(gid)
-            if tile:
-                platform = Platform(tile, (x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE), self.tmx_map.tilewidth, self.tmx_map.tileheight)
-                self.platforms.add(platform)
-                self.all_sprites.add(platform)
-
-        try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('portals'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    platform = Platform(pg.image.load('resourses/images/portal/Green Portal Sprite Sheet.png'), (x * self.tmx_map.tilewidth * TILE_SIZE - 32, y * self.tmx_map.tileheight * TILE_SIZE - 64), 64, 64, True, 8, 2.5)
-                    self.portals.add(platform)
-                    self.all_sprites.add(platform)
-        except:
-            print('Portals not found')
-
         try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('enemys area'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    area = AreaBlock((x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE))
-                    self.area_blocks.add(area)
+            with report.scope('enemys area'):
+                for x, y, gid in self.tmx_map.get_layer_by_name('enemys area'):
+                    tile = self.tmx_map.get_tile_image_by_gid(gid)
+                    if tile:
+                        area = report.entity('enemys area', AreaBlock, (x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE))
+                        self.area_blocks.add(area)
+                        self.area_grid.add(area)
         except:
             print('Area not found')
 
+        # Дыры вылетают из всех точек разом на тиках black_hole_launches, спрайты им даёт update_black_holes
+        self.black_hole_pool = EntityPool(Black_Hole)
+        self.black_hole_spawns = []
+        self.black_hole_launches = [sim_clock.tick]
         try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('bombs'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    enemy = Bomb((x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE))
-                    self.bombs.add(enemy)
-                    self.all_sprites.add(enemy)
-        except:
-            print('Bombs not found')
-
-        try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('worms'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    enemy = Worm((x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE))
-                    self.worms.add(enemy)
-                    self.all_sprites.add(enemy)
-        except:
-            print('Worms not found')
-
-        self.black_holes_spawns = []
-        try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('black holes'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    enemy = Black_Hole((x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE))
-                    self.black_holes_spawns.append((x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE))
-                    self.black_holes.add(enemy)
-                    self.all_sprites.add(enemy)
+            with report.scope('black holes'):
+                size = 32 * TILE_SIZE / 2
+                for x, y, gid in self.tmx_map.get_layer_by_name('black holes'):
+                    tile = self.tmx_map.get_tile_image_by_gid(gid)
+                    if tile:
+                        self.black_hole_spawns.append(pg.Rect(x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE, size, size))
+                report.count('black holes', len(self.black_hole_spawns))
         except:
             print('Black holes not found')
 
-        try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('ghosts'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    platform = Platform(tile, (x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE), self.tmx_map.tilewidth, self.tmx_map.tileheight)
-                    self.all_sprites.add(platform)
-        except:
-            print('Ghosts not found')
-
-        try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('spikes'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    platform = Platform(tile, (x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE), self.tmx_map.tilewidth, self.tmx_map.tileheight)
-                    self.spikes.add(platform)
-                    self.all_sprites.add(platform)
-        except:
-            print('Spikes not found')
-
-        try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('checkpoints'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    platform = Platform(pg.image.load('resourses/images/flag/Flag.png'), (x * self.tmx_map.tilewidth * TILE_SIZE, y * self.tmx_map.tileheight * TILE_SIZE - self.tmx_map.tileheight // 2), 48, 48, True, 4)
-                    self.checkpoints.add(platform)
-                    self.all_sprites.add(platform)
-        except:
-            print('Checkpoints not found')
+        # Остальные слои создаются по чанкам в stream()
+        for name in TILE_LAYERS[1:] + STREAMED_ENTITIES:
+            if name not in self.tmx_map.layers:
+                print(f'{name.capitalize()} not found')
+        self.tileset = TileSet(self.tmx_map)
+        self.tile_layers = {name: TileLayer(self.tileset, cell_size) for name in TILE_LAYERS}
+        self.static_layers = ChunkRenderer([self.tile_layers[name] for name in TILE_LAYERS], cell_size)
+        self.layer_sizes = {name: sum(1 for x, y, gid in self.tmx_map.get_layer_by_name(name) if self.tmx_map.get_tile_image_by_gid(gid))
+                            for name in STREAMED_ENTITIES if name in self.tmx_map.layers}
+        self.streamer = ChunkStreamer(cell_size * CHUNK_TILES, -(-self.tmx_map.width // CHUNK_TILES), -(-self.tmx_map.height // CHUNK_TILES), self.load_chunk, self.unload_chunk)
+        self.reset_stream()
+
+        self.snapshot = self.take_snapshot()
+        self.stream()
+
+    def reset_stream(self):
+        # Забывает все чанки вместе с сохранёнными сущностями, мир заново подгрузится вокруг камеры
+        for entities in self.streamer.loaded.values():
+            for key, sprite in entities:
+                sprite.kill()
+        self.streamer.clear()
+        for layer in self.tile_layers.values():
+            layer.clear()
+        self.streamed = {}  # (слой, x, y) -> спрайт загруженной сущности
+        self.removed = set()  # сущности, которые собраны или убиты
+        self.saved = {}  # (слой, x, y) -> (состояние, тик засыпания) выгруженной сущности
+        self.parked = {}  # чанк -> выгруженные сущности, которые в нём стоят
+
+        cell_size = self.tmx_map.tilewidth * TILE_SIZE
+        self.checkpoints_grid = SpatialGrid(cell_size)
+        self.coins_grid = SpatialGrid(cell_size)
+        self.enemies = self.create_enemy_engine()
+        self.activity = self.create_activity_regions()
+
+    def report_level(self):
+        # Бюджеты считаются на весь уровень, а не на чанки у камеры: догружаем остальные и начинаем заново
+        self.streamer.load_all()
+        report = self.load_report
+        report.finish()
+        # Догрузка всего уровня ради отчёта не должна попасть в счётчики стриминга самой игры
+        self.streamer.loads = self.streamer.unloads = 0
+        self.restart()
+
+        print(report.table())
+        with open(self.load_report_path, 'w', encoding='utf-8') as f:
+            json.dump(report.stats(), f, ensure_ascii=False, indent=2)
+        if report.over_budget():
+            raise ValueError('Level load is over budget: ' + '; '.join(report.over_budget()))
+
+    def created_surfaces(self):
+        # Картинки из кэшей и растянутые тайлы. Чанки фона запекаются позже, при отрисовке
+        return assets.created + texts.created + (len(self.tileset.images) if self.tileset else 0)
+
+    def stream(self):
+        velocity = (self.camera_x - self.previous_camera[0], self.camera_y - self.previous_camera[1])
+        if max(abs(velocity[0]), abs(velocity[1])) > INTERPOLATION_LIMIT:
+            velocity = (0, 0)  # камера перескочила, а не движется
+        self.streamer.update(pg.Rect(self.camera_x, self.camera_y, SCREEN_WIDTH, SCREEN_HEIGHT), velocity)
+
+    def make_entity(self, layer, x, y):
+        tilewidth, tileheight = self.tmx_map.tilewidth, self.tmx_map.tileheight
+        left, top = x * tilewidth * TILE_SIZE, y * tileheight * TILE_SIZE
+        if layer == 'portals':
+            return Platform('resourses/images/portal/Green Portal Sprite Sheet.png', (left - 32, top - 64), 64, 64, 8, 2.5)
+        if layer == 'checkpoints':
+            return Platform('resourses/images/flag/Flag.png', (left, top - tileheight // 2), 48, 48, 4)
+        if layer == 'coins':
+            return Platform('resourses/images/coins/Coin.png', (left + tilewidth - 10, top + tileheight - 10), 10, 10, 4, 2.5)
+        if layer == 'bombs':
+            return Bomb((left, top))
+        if layer == 'worms':
+            return Worm((left, top))
+
+    def layer_containers(self, layer):
+        # Группы и сетки, в которых лежат спрайты слоя
+        return {
+            'portals': ((self.portals, self.all_sprites), ()),
+            'checkpoints': ((self.checkpoints, self.all_sprites), (self.checkpoints_grid,)),
+            'coins': ((self.coins, self.all_sprites), (self.coins_grid,)),
+            'bombs': ((self.bombs, self.all_sprites), ()),
+            'worms': ((self.worms, self.all_sprites), ()),
+        }[layer]
+
+    def load_chunk(self, chunk):
+        report = self.load_report
+        for layer in TILE_LAYERS:
+            with report.scope(layer):
+                cells = self.tmx_map.chunk_cells(layer, chunk)
+                self.tile_layers[layer].add_chunk(chunk, cells)
+                report.count(layer, len(cells))
+
+        entities = []
+        for layer in STREAMED_ENTITIES:
+            with report.scope(layer):
+                for x, y, gid in self.tmx_map.chunk_cells(layer, chunk):
+                    key = (layer, x, y)
+                    if key in self.removed or key in self.saved or key in self.streamed:
+                        continue
+                    if self.tmx_map.get_tile_image_by_gid(gid):
+                        entities.append(self.attach(key, report.entity(layer, self.make_entity, layer, x, y), 1))
+
+        for key in self.parked.pop(chunk, ()):
+            state, tick = self.saved.pop(key)
+            sprite = self.make_entity(*key)
+            set_sprite_state(sprite, state)
+            entities.append(self.attach(key, sprite, tick))
+        return entities
+
+    def attach(self, key, sprite, tick):
+        layer = key[0]
+        groups, grids = self.layer_containers(layer)
+        for group in groups:
+            group.add(sprite)
+        for grid in grids:
+            grid.add(sprite)
+
+        self.streamed[key] = sprite
+        if self.enemies and layer in ('bombs', 'worms'):
+            self.enemies.add((sprite,))
+        elif layer in self.activity:
+            self.activity[layer].sleep(sprite, tick)
+        return key, sprite
+
+    def unload_chunk(self, chunk, entities):
+        # Живые сущности, ушедшие в соседний загруженный чанк, переезжают в него,
+        # остальные запоминаются в чанке, где сейчас стоят
+        for layer in self.tile_layers.values():
+            layer.remove_chunk(chunk)
+
+        if self.enemies:
+            # Чанк, куда ушёл враг, считается по его rect, а он синхронизирован только рядом с игроком и камерой
+            self.enemies.sync_sprites(sprite for key, sprite in entities if key[0] in ('bombs', 'worms'))
+        leaving = []
+        for key, sprite in entities:
+            home = self.streamer.chunk_at(sprite.rect.center)
+            if sprite.alive() and home != chunk and home in self.streamer.loaded:
+                self.streamer.loaded[home].append((key, sprite))
+            else:
+                leaving.append((key, sprite, home))
+
+        if self.enemies:
+            self.enemies.remove(sprite for key, sprite, home in leaving if key[0] in ('bombs', 'worms'))
+        for key, sprite, home in leaving:
+            layer = key[0]
+            del self.streamed[key]
+            tick = self.activity[layer].remove(sprite, sim_clock.tick + 1) if layer in self.activity else None
+            animations.stop(sprite)
+            if sprite.alive():
+                self.saved[key] = (get_sprite_state(sprite), tick)
+                self.parked.setdefault(home, []).append(key)
+            else:
+                self.removed.add(key)
+            sprite.kill()
+            for grid in self.layer_containers(layer)[1]:
+                grid.remove(sprite)
+
+    def create_enemy_engine(self):
+        if not self.batched_enemies:
+            return None
+        return EnemyEngine(self.bombs.sprites() + self.worms.sprites(), self.tmx_map, self.tmx_map.tilewidth * TILE_SIZE)
+
+    def create_activity_regions(self):
+        cell_size = int(self.tmx_map.tilewidth * TILE_SIZE * CHUNK_TILES)
+        # Спрайты попадают сюда из load_chunk. Монетам, флагам и порталам обновляться не нужно,
+        # их кадры берутся из общих циклов AnimationClock
+        return {name: ActivityRegion((), cell_size, sim_clock.tick + 1) for name in ('bombs', 'worms')}
+
+    def nearby(self, name):
+        # Враги, которые могут задеть игрока или его снаряды: проснувшиеся, а с EnemyEngine - синхронизированные на этом тике
+        if self.enemies:
+            return self.enemies.nearby(getattr(self, name))
+        return self.activity[name].awake
+
+    def update_black_holes(self, area):
+        # Дыра стоит, пока появляется, и потом летит влево по прямой, так что её положение считается
+        # от тика вылета. Спрайт есть только у тех, что задевают активную область
+        tick = sim_clock.tick
+        if self.black_holes_timer + self.black_holes_interval <= sim_clock.get_ticks():
+            self.black_holes_timer = sim_clock.get_ticks()
+            self.black_hole_launches.append(tick)
+        # Улетевшие за левый край карты больше не нужны
+        reach = max((rect.x for rect in self.black_hole_spawns), default=0)
+        self.black_hole_launches = [launch for launch in self.black_hole_launches if reach - black_hole_shift(launch, tick) >= -100]
+
+        active = set()
+        for launch in self.black_hole_launches:
+            shift = black_hole_shift(launch, tick)
+            for index in area.move(shift, 0).collidelistall(self.black_hole_spawns):
+                spawn = self.black_hole_spawns[index].topleft
+                if spawn[0] - shift >= -100:
+                    active.add((spawn, launch))
+
+        for sprite in self.black_holes.sprites():
+            key = (sprite.spawn, sprite.launch)
+            if key in active:
+                active.remove(key)
+                sprite.update()
+            else:
+                sprite.kill()
+        for spawn, launch in sorted(active):
+            self.black_hole_pool.acquire(spawn, launch, groups=(self.black_holes, self.all_sprites))
+
+    def catch_up(self, sprite, ticks):
+        for _ in range(min(ticks, MAX_CATCH_UP_TICKS)):
+            sprite.update(self.collider, self.area_grid)
+
+    def take_snapshot(self):
+        return {
+            'tick': sim_clock.tick,
+            'sprites': [(sprite, get_sprite_state(sprite)) for sprite in self.all_sprites],
+            'groups': {name: getattr(self, name).sprites() for name in SNAPSHOT_GROUPS},
+            'black_holes_timer': self.black_holes_timer,
+            'black_hole_launches': list(self.black_hole_launches),
+            'animations': dict(animations.playing),
+        }
+
+    def restore(self, snapshot):
+        # Возвращает мир к снимку, переиспользуя те же объекты спрайтов без загрузки ассетов.
+        # Часы симуляции тоже откатываются, поэтому таймеры спрайтов остаются согласованными
+        sim_clock.tick = snapshot['tick']
+        animations.reset(sim_clock.get_ticks(), snapshot['animations'])
+        for sprite, state in snapshot['sprites']:
+            set_sprite_state(sprite, state)
+
+        for name, sprites in snapshot['groups'].items():
+            group = getattr(self, name)
+            group.empty()
+            group.add(*sprites)
+        self.player.fireballs.empty()
+        self.reset_stream()
+
+        self.black_holes_timer = snapshot['black_holes_timer']
+        self.black_hole_launches = list(snapshot['black_hole_launches'])
+        self.mode = 'game'
+        self.camera_x = 0
+        self.camera_y = 0
+        self.previous_camera = (0, 0)
+        self.previous_positions = {}
+        self.stream()
 
-        try:
-            for x, y, gid in self.tmx_map.get_layer_by_name('coins'):
-                tile = self.tmx_map.get_tile_image_by_gid(gid)
-                if tile:
-                    platform = Platform(pg.image.load('resourses/images/coins/Coin.png'), (x * self.tmx_map.tilewidth * TILE_SIZE + self.tmx_map.tilewidth - 10, y * self.tmx_map.tileheight * TILE_SIZE + self.tmx_map.tileheight - 10), 10, 10, True, 4, 2.5)
-                    self.coins.add(platform)
-                    self.all_sprites.add(platform)
-        except:
-            print('Coins not found')
+    def restart(self):
+        self.restore(self.snapshot)
 
-        self.run()
+    def new_run(self):
+        # Новый мир, но с сохранённым прогрессом, иначе следующее автосохранение затрёт покупки
+        self.restart()
+        self.load_saved_progress()
 
     def menu_on(self):
         self.mode = 'menu'
         self.menu.mode = 'main'
 
     def save(self):
+        # Выход из игры: дожидаемся записи, чтобы процесс не завершился раньше
+        if not self.saver:
+            return
         self.data['settings']['resolution'] = self.resolution
         self.data['settings']['view_mode'] = self.view_mode
-        with open('save.json', 'w', encoding='utf-8') as outdata:
-            json.dump(self.data, outdata, ensure_ascii=False)
+        self.autosave()
+        self.saver.flush()
+
+    def autosave(self):
+        if not self.saver:
+            return
+        # После смерти прогресс не перезаписываем, иначе следующий запуск начнётся с game over
+        if self.player.hp > 0:
+            self.data['progress'] = self.progress()
+        self.saver.request(json.dumps(self.data, ensure_ascii=False))
+
+    def progress(self):
+        return {
+            'money': self.player.money,
+            'hp': self.player.hp,
+            'fireballs': self.player.fireballs_count,
+            'jump_height': self.player.jump_height,
+            'spawn': self.player.spawn,
+        }
+
+    def load_saved_progress(self):
+        # Запись начинается с нового мира и воспроизводится без сохранения, прогресс в неё не подмешивается
+        if self.saver and not self.recorder and 'progress' in self.data:
+            self.load_progress(self.data['progress'])
+
+    def load_progress(self, progress):
+        self.player.money = progress['money']
+        self.player.hp = progress['hp']
+        self.player.fireballs_count = progress['fireballs']
+        self.player.jump_height = progress['jump_height']
+        self.player.spawn = tuple(progress['spawn'])
+        self.player.rect.center = self.player.spawn
 
     def run(self):
         self.is_running = True
+        step = 1000 / TICK_RATE
+        accumulator = 0
+        previous_time = pg.time.get_ticks()
         while self.is_running:
-            self.event()
-            self.update()
-            self.draw()
+            now = pg.time.get_ticks()
+            accumulator += now - previous_time
+            previous_time = now
+
+            self.profiler.begin_frame()
+            with self.profiler.scope('event'):
+                self.event()
+
+            # Если не успеваем, делаем несколько шагов подряд без отрисовки,
+            # но не больше MAX_FRAME_SKIP, чтобы не уйти в бесконечное догоняние
+            steps = 0
+            while accumulator >= step and steps < MAX_FRAME_SKIP:
+                with self.profiler.scope('update'):
+                    self.update()
+                accumulator -= step
+                steps += 1
+            if steps == MAX_FRAME_SKIP:
+                accumulator = min(accumulator, step)
+
+            with self.profiler.scope('draw'):
+                self.draw(accumulator / step)
+            self.profiler.end_frame()
             self.clock.tick(FPS)
+        if self.recorder:
+            self.recorder.close(self.state_digest())
+        self.profiler.close()
         pg.quit()
         quit()
 
+    def simulate(self, inputs, ticks):
+        # inputs - последовательность нажатых клавиш на каждый тик, после её конца клавиши отпущены
+        inputs = iter(inputs)
+        self.input_source = lambda: KeyState(next(inputs, ()))
+
+        start = time.perf_counter()
+        for _ in range(ticks):
+            self.profiler.begin_frame()
+            with self.profiler.scope('update'):
+                self.update()
+            self.profiler.end_frame()
+        elapsed = time.perf_counter() - start
+        self.profiler.close()
+
+        result = {'ticks': ticks, 'seconds': elapsed, 'ticks_per_second': ticks / elapsed if elapsed else 0, 'state': self.state(), 'stream': self.streamer.stats(), 'assets': assets.stats()}
+        if self.profiler.enabled:
+            result['profile'] = self.profiler.stats()
+        return result
+
+    def record(self, path, seed=None):
+        # Запись всегда начинается с нового мира, без загруженного прогресса
+        self.restart()
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), 'little')
+        random.seed(seed)
+        self.recorder = ReplayRecorder(path, seed, self.resolution, self.view_mode, self.batched_enemies)
+
+    def replay(self, replay):
+        # Мир должен быть только что создан с настройками из записи, см. __main__
+        random.seed(replay.seed)
+
+        start = time.perf_counter()
+        for events, count, keys in replay.records:
+            for event in events:
+                self.handle_event(event)
+            self.input_source = lambda: keys
+            for _ in range(count):
+                self.profiler.begin_frame()
+                with self.profiler.scope('update'):
+                    self.update()
+                self.profiler.end_frame()
+        elapsed = time.perf_counter() - start
+        self.profiler.close()
+
+        ticks = replay.ticks()
+        digest = self.state_digest()
+        return {'ticks': ticks, 'seconds': elapsed, 'ticks_per_second': ticks / elapsed if elapsed else 0, 'state': self.state(),
+                'digest': digest.hex(), 'matches': digest == replay.digest if replay.digest else None}
+
+    def state_digest(self):
+        return hashlib.sha1(json.dumps(self.full_state(), sort_keys=True).encode()).digest()
+
+    def full_state(self):
+        # state() и то, что нужно для сравнения записей: где стоит и куда идёт каждая сущность,
+        # что выгружено, что собрано или убито. Червей и бомб в EnemyEngine читаем из его массивов,
+        # спрайты вдали от камеры он не обновляет
+        engine = {}
+        if self.enemies:
+            enemies = self.enemies
+            engine = {sprite: ((int(enemies.x[i]), int(enemies.y[i])), bool(enemies.direction[i]), int(enemies.velocity_x[i]))
+                      for i, sprite in enumerate(enemies.sprites)}
+        entities = []
+        for key, sprite in self.streamed.items():
+            if sprite.alive():
+                position, direction, velocity = engine.get(sprite) or (sprite.rect.topleft, getattr(sprite, 'direction', None), getattr(sprite, 'velocity_x', None))
+                entities.append([key, position, direction, velocity])
+        return {
+            **self.state(),
+            'entities': sorted(entities),
+            'black_hole_sprites': sorted([sprite.spawn, sprite.rect.topleft, sprite.velocity_x] for sprite in self.black_holes),
+            'black_hole_launches': self.black_hole_launches,
+            'saved': sorted([key, tick, state['rect'].topleft] for key, (state, tick) in self.saved.items()),
+            'removed': sorted(self.removed),
+            'black_holes_timer': self.black_holes_timer,
+        }
+
+    def state(self):
+        return {
+            'mode': self.mode,
+            'player': {
+                'position': self.player.rect.topleft,
+                'velocity': (self.player.velocity_x, self.player.velocity_y),
+                'hp': self.player.hp,
+                'money': self.player.money,
+                'fireballs': self.player.fireballs_count,
+                'spawn': self.player.spawn,
+            },
+            'coins': self.population('coins'),
+            'bombs': self.population('bombs'),
+            'worms': self.population('worms'),
+            'black_holes': len(self.black_holes),
+            'pools': self.pool_stats(),
+        }
+
+    def population(self, name):
+        # Живые сущности слоя вместе с выгруженными и ещё ни разу не загруженными
+        unloaded = self.layer_sizes.get(name, 0) - sum(1 for key in self.removed if key[0] == name) - sum(1 for key in self.streamed if key[0] == name)
+        return len(getattr(self, name)) + unloaded
+
+    def pool_stats(self):
+        return {
+            'fireballs': self.player.fireball_pool.stats(),
+            'black_holes': self.black_hole_pool.stats(),
+        }
+
     def event(self):
         for event in pg.event.get():
-            if event.type == pg.QUIT:
-                self.save()
-                self.is_running = False
-            if self.mode == 'game over':
-                if event.type == pg.KEYDOWN:
-                    self.setup()
-            if self.mode == 'game':
-                if event.type == pg.KEYDOWN:
-                    if event.key == pg.K_e:
-                        self.player.attack(self.all_sprites)
-                    if event.key == pg.K_p:
-                        self.setup()
-                for button in self.buttons:
-                    button.is_clicked(event)
-            elif self.mode == 'menu':
-                self.menu.is_clicked(event)
-                if event.type == pg.KEYDOWN:
-                    if event.key == pg.K_ESCAPE:
-                        if self.menu.quit:
-                            self.save()
-                            self.is_running = False
-                        self.mode = 'game'
+            if hasattr(event, 'pos'):
+                event = pg.event.Event(event.type, event.dict, pos=self.to_screen(event.pos))
+            if self.recorder:
+                self.recorder.event(event)
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        if event.type == pg.QUIT:
+            self.save()
+            self.is_running = False
+        if event.type == pg.KEYDOWN and event.key == PROFILER_KEY:
+            self.profiler.toggle()
+        if self.mode == 'game over':
+            if event.type == pg.KEYDOWN:
+                self.new_run()
+        if self.mode == 'game':
+            if event.type == pg.KEYDOWN:
+                if event.key == pg.K_e:
+                    self.player.attack(self.all_sprites)
+                if event.key == pg.K_p:
+                    self.new_run()
+            for button in self.buttons:
+                button.is_clicked(event)
+        elif self.mode == 'menu':
+            self.menu.is_clicked(event)
+            if event.type == pg.KEYDOWN:
+                if event.key == pg.K_ESCAPE:
+                    self.mode = 'game'
 
     def update(self):
+        keys = self.input_source()
+        if self.recorder:
+            self.recorder.tick(keys)
+
+        self.previous_camera = (self.camera_x, self.camera_y)
+        self.previous_positions = {sprite: sprite.rect.topleft for group in ((self.player,), self.player.fireballs, self.nearby('bombs'), self.nearby('worms'), self.black_holes) for sprite in group}
+
         if self.player.hp <= 0:
             self.mode = 'game over'
             return
@@ -863,46 +2774,37 @@ class Game:
             return
 
         if self.mode == 'game':
-            self.bombs.update(self.platforms, self.area_blocks)
-            self.coins.update()
-            self.checkpoints.update()
-            self.portals.update()
-            self.worms.update(self.platforms, self.area_blocks)
-            self.black_holes.update()
-            if self.black_holes_timer + self.black_holes_interval <= pg.time.get_ticks():
-                self.black_holes_timer = pg.time.get_ticks()
-                for spawn in self.black_holes_spawns:
-                    enemy = Black_Hole(spawn)
-                    self.black_holes.add(enemy)
-                    self.all_sprites.add(enemy)
-
-            self.player.update(self.platforms, self.coins, self.checkpoints)
-            self.player.fireballs.update()
-            pg.sprite.groupcollide(self.player.fireballs, self.platforms, True, False)
-            pg.sprite.groupcollide(self.player.fireballs, self.worms, True, True)
-            pg.sprite.groupcollide(self.player.fireballs, self.bombs, True, True)
-
-            hits = pg.sprite.spritecollide(self.player, self.bombs, False)
-            for hit in hits:
-                hit.current_animation = hit.boom_animation
-                self.player.get_damage(3)
-
-            hits = pg.sprite.spritecollide(self.player, self.worms, False)
-            for hit in hits:
-                self.player.get_damage(1)
-
-            hits = pg.sprite.spritecollide(self.player, self.spikes, False)
-            for hit in hits:
-                self.player.get_damage(2)
-                self.player.rect.center = self.player.spawn
-
-            hits = pg.sprite.spritecollide(self.player, self.black_holes, False)
-            for hit in hits:
-                self.player.get_damage(2)
-
-            hits = pg.sprite.spritecollide(self.player, self.portals, False, pg.sprite.collide_mask)
-            for hit in hits:
-                self.mode = 'winner'
+            sim_clock.tick += 1
+            animations.tick(sim_clock.get_ticks())
+            view = pg.Rect(self.camera_x, self.camera_y, SCREEN_WIDTH, SCREEN_HEIGHT)
+            area = view.inflate(ACTIVE_MARGIN * 2, ACTIVE_MARGIN * 2)
+
+            scope = self.profiler.scope
+            if self.enemies:
+                with scope('update.enemies'):
+                    self.enemies.update(self.collider, self.area_grid)
+            else:
+                with scope('update.bombs'):
+                    self.activity['bombs'].update(area, sim_clock.tick, self.catch_up).update(self.collider, self.area_grid)
+            if not self.enemies:
+                with scope('update.worms'):
+                    self.activity['worms'].update(area, sim_clock.tick, self.catch_up).update(self.collider, self.area_grid)
+            with scope('update.black_holes'):
+                self.update_black_holes(area)
+
+            with scope('update.player'):
+                spawn = self.player.spawn
+                self.player.update(self.collider, self.coins_grid, self.checkpoints_grid, keys)
+                if self.player.spawn != spawn:
+                    self.autosave()
+            with scope('update.fireballs'):
+                self.player.fireballs.update(self.collider)
+
+            if self.enemies:
+                with scope('update.enemies'):
+                    self.enemies.sync_near([self.player.rect] + [fireball.rect for fireball in self.player.fireballs])
+            with scope('collisions'):
+                self.collide()
 
             if self.view_mode:
                 self.camera_x = (self.player.rect.centerx - 100) // (SCREEN_WIDTH - 200) * (SCREEN_WIDTH - 200)
@@ -914,23 +2816,78 @@ class Game:
             self.camera_x = max(0, min(self.camera_x, self.map_width - SCREEN_WIDTH))
             self.camera_y = max(0, min(self.camera_y, self.map_height - SCREEN_HEIGHT))
 
-    def draw(self):
-        self.screen.blit(self.bg, (0, 0))
-
-        for sprite in self.all_sprites:
-            self.screen.blit(sprite.image, sprite.rect.move(-self.camera_x, -self.camera_y))
-
-        for button in self.buttons:
-            button.draw(self.screen)
-
-        for i in range(self.player.hp):
-            self.screen.blit(self.heart, (SCREEN_WIDTH + (i + 1) * -30, 0))
-
-        self.screen.blit(self.coin_image, (0, 0))
-        self.screen.blit(self.bullet_image, (0, 30))
-
-        self.screen.blit(text_render(self.player.money, 'yellow'), (30, 3))
-        self.screen.blit(text_render(self.player.fireballs_count, 'red'), (30, 33))
+            with scope('update.stream'):
+                self.stream()
+            if self.enemies:
+                # После сдвига камеры, иначе после возрождения рисовались бы враги с прошлого места
+                with scope('update.enemies'):
+                    self.enemies.sync_near([pg.Rect(self.camera_x, self.camera_y, SCREEN_WIDTH, SCREEN_HEIGHT).inflate(ENEMY_SYNC_MARGIN * 2, ENEMY_SYNC_MARGIN * 2)])
+
+    def collide(self):
+        pg.sprite.groupcollide(self.player.fireballs, self.nearby('worms'), True, True)
+        pg.sprite.groupcollide(self.player.fireballs, self.nearby('bombs'), True, True)
+
+        hits = pg.sprite.spritecollide(self.player, self.nearby('bombs'), False)
+        for hit in hits:
+            hit.explode()
+            self.player.get_damage(3)
+
+        hits = pg.sprite.spritecollide(self.player, self.nearby('worms'), False)
+        for hit in hits:
+            self.player.get_damage(1)
+
+        hits = self.tile_layers['spikes'].query(self.player.rect)
+        for hit in hits:
+            self.player.get_damage(2)
+            self.player.rect.center = self.player.spawn
+
+        hits = pg.sprite.spritecollide(self.player, self.black_holes, False)
+        for hit in hits:
+            self.player.get_damage(2)
+
+        hits = pg.sprite.spritecollide(self.player, self.portals, False, pg.sprite.collide_mask)
+        for hit in hits:
+            self.mode = 'winner'
+
+    def render_groups(self):
+        # Спрайты слоёв отрисовки, внутри слоя группы тоже рисуются в этом порядке
+        return {
+            'pickups': (self.portals, self.checkpoints, self.coins),
+            'enemies': (self.bombs, self.worms, self.black_holes),
+            'player': ((self.player,),),
+            'projectiles': (self.player.fireballs,),
+        }
+
+    def draw(self, alpha=1):
+        # alpha - доля шага симуляции, прошедшая после последнего update
+        camera_x = interpolate(self.previous_camera[0], self.camera_x, alpha)
+        camera_y = interpolate(self.previous_camera[1], self.camera_y, alpha)
+
+        scope = self.profiler.scope
+        batches = self.batches
+        with scope('draw.level'):
+            batches['background'].add(self.bg, (0, 0))
+            self.static_layers.draw(batches['tiles'], camera_x, camera_y, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+        with scope('draw.sprites'):
+            view = pg.Rect(camera_x, camera_y, SCREEN_WIDTH, SCREEN_HEIGHT)
+            for name, groups in self.render_groups().items():
+                batch = batches[name]
+                for group in groups:
+                    for sprite in group:
+                        if view.colliderect(sprite.rect):
+                            x, y = sprite.rect.topleft
+                            if sprite in self.previous_positions:
+                                previous_x, previous_y = self.previous_positions[sprite]
+                                x, y = interpolate(previous_x, x, alpha), interpolate(previous_y, y, alpha)
+                            batch.add(sprite.image, (x - camera_x, y - camera_y))
+
+        with scope('draw.hud'):
+            self.hud.draw(batches['hud'])
+
+        with scope('draw.blits'):
+            for name in RENDER_LAYERS:
+                batches[name].draw(self.screen)
 
         if self.mode == 'winner':
             self.screen.blit(text_render('WINNER', 'yellow'), (SCREEN_WIDTH//2-50, SCREEN_HEIGHT//2-10))
@@ -942,8 +2899,198 @@ class Game:
         if self.mode == 'menu':
             self.menu.draw(self.screen)
 
-        pg.display.flip()
+        if self.profiler.enabled:
+            self.profiler.draw(self.screen)
+
+        with scope('draw.present'):
+            self.present()
+
+
+def build_atlas(path=ATLAS_MANIFEST):
+    # Игра собирается без окна и без старого атласа, подгружает все чанки и создаёт то,
+    # что появляется только по ходу игры. Всё, что она при этом попросила у assets, уходит в атлас
+    assets.max_items = math.inf
+    start = time.perf_counter()
+    game = Game(headless=True, atlas=False)
+    game.streamer.load_all()
+    Fireball(game.player.rect, True)
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    images = assets.final_images()
+    manifest = {'version': ATLAS_VERSION, 'pages': [], 'images': [], 'sources': {}}
+    for page, placed in enumerate(pack_atlas(images)):
+        width = max(x + image.get_width() for key, image, x, y in placed)
+        height = max(y + image.get_height() for key, image, x, y in placed)
+        sheet = pg.Surface((width, height), pg.SRCALPHA)
+        for (source, rect, image_size, flip), image, x, y in placed:
+            sheet.blit(image, (x, y))
+            manifest['images'].append([source, rect, image_size, flip, page, x, y])
+            stat = os.stat(source)
+            manifest['sources'][source] = [stat.st_mtime_ns, stat.st_size]
+        name = f'atlas {page}.png'
+        pg.image.save(sheet, os.path.join(directory, name))
+        manifest['pages'].append(name)
+
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+    return {'pages': len(manifest['pages']), 'images': len(manifest['images']), 'seconds': time.perf_counter() - start}
+
+
+def benchmark_route(level, legs):
+    # Точки, где можно стоять (твёрдая клетка, над ней две пустые), равномерно по ширине карты слева направо.
+    # В каждом столбце берём самую нижнюю - это пол, а не потолок
+    route = []
+    for leg in range(legs):
+        for x in range(leg * level.width // legs, level.width):
+            floors = [y for y in range(2, level.height) if level.solid[y * level.width + x] and not level.solid[(y - 1) * level.width + x] and not level.solid[(y - 2) * level.width + x]]
+            if floors:
+                route.append((x, floors[-1]))
+                break
+    return route
+
+
+def benchmark_run(game, ticks):
+    # Игрок бежит вправо, подпрыгивая, и не умирает: hp восстанавливается каждый тик. Каждые
+    # BENCHMARK_LEG_TICKS тиков, а также если он дошёл до портала, он переносится на следующую точку
+    # benchmark_route, так что за прогон проходит всю карту, сколько бы раз она ни была повторена
+    level = game.tmx_map
+    size = level.tilewidth * TILE_SIZE
+    route = benchmark_route(level, max(1, ticks // BENCHMARK_LEG_TICKS))
+    running, jumping = KeyState((pg.K_d,)), KeyState((pg.K_d, pg.K_w))
+    player = game.player
+    hp = player.hp
+    leg = -1
+
+    start = time.perf_counter()
+    for tick in range(ticks):
+        if tick % BENCHMARK_LEG_TICKS == 0 or game.mode == 'winner':
+            leg = min(leg + 1, len(route) - 1)
+            x, y = route[leg]
+            player.rect.midbottom = (x * size + size // 2, y * size)
+            player.velocity_x = player.velocity_y = 0
+            game.mode = 'game'
+        player.hp = hp
+        game.input_source = lambda: jumping if tick % 40 < 10 else running
+        game.update()
+    elapsed = time.perf_counter() - start
+
+    if game.mode != 'game':
+        raise ValueError(f'Benchmark run ended in "{game.mode}" mode')
+    return ticks / elapsed
+
+
+def benchmark(scales=BENCHMARK_SCALES, ticks=BENCHMARK_TICKS, frames=BENCHMARK_FRAMES, repeats=BENCHMARK_REPEATS):
+    # Скорости - лучшие из повторов, память - пик tracemalloc за setup и прогон,
+    # он меряется отдельно, потому что tracemalloc замедляет остальное
+    game = Game(headless=True)
+    level = game.tmx_map
+    results = {'python': platform.python_version(), 'pygame': pg.version.ver, 'maps': {}}
+    for scale in scales:
+        game.tmx_map = level.repeated(scale)
+        result = {'tiles': sum(len(data) // 3 for data in game.tmx_map.layers.get('level', {}).values()),
+                  'enemies': sum(len(data) // 3 for name in ('bombs', 'worms', 'black holes') for data in game.tmx_map.layers.get(name, {}).values())}
+
+        tracemalloc.start()
+        random.seed(0)
+        game.setup()
+        benchmark_run(game, ticks)
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+
+        setup, update = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            game.setup()
+            setup.append((time.perf_counter() - start) * 1000)
+            random.seed(0)
+            update.append(benchmark_run(game, ticks))
+        result['setup_ms'] = min(setup)
+        result['ticks_per_second'] = max(update)
+        result['stream'] = game.streamer.stats()
+        result['assets'] = assets.stats()
+
+        resolution = game.resolution
+        result['fps'] = {}
+        for i, size in enumerate(RESOLUTIONS):
+            game.set_resolution(i)
+            game.draw()
+            fps = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                for _ in range(frames):
+                    game.draw()
+                fps.append(frames / (time.perf_counter() - start))
+            result['fps'][f'{size[0]}x{size[1]}'] = max(fps)
+        game.set_resolution(resolution)
+        results['maps'][f'{scale}x'] = result
+    return results
+
+
+def compare_benchmark(results, baseline, tolerance=BENCHMARK_TOLERANCE):
+    # Скорости (ticks_per_second, fps) должны быть не меньше базовых, время и память - не больше
+    regressions = []
+    for name, base in baseline['maps'].items():
+        current = results['maps'].get(name)
+        if current is None:
+            continue
+        metrics = [(key, base[key], current[key], key == 'ticks_per_second') for key in ('setup_ms', 'peak_kb', 'ticks_per_second')]
+        metrics += [(f'fps {size}', fps, current['fps'][size], True) for size, fps in base['fps'].items() if size in current['fps']]
+        for key, old, new, higher_is_better in metrics:
+            change = (new - old) / old if old else 0
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f'{name} {key}: {old:.1f} -> {new:.1f} ({change:+.0%})')
+    return regressions
 
 
 if __name__ == "__main__":
-    game = Game()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--headless', action='store_true', help='simulate without a window and print the result as JSON')
+    parser.add_argument('--ticks', type=int, default=1000)
+    parser.add_argument('--inputs', help='JSON file with a list of pressed key names per tick, e.g. [["d"], ["d", "space"]]')
+    parser.add_argument('--batched-enemies', action='store_true', help='move worms and bombs with the numpy EnemyEngine')
+    parser.add_argument('--profile', help='enable the frame profiler and write per-frame timings to this .csv or .jsonl file')
+    parser.add_argument('--record', help='record the input of this session into a replay file')
+    parser.add_argument('--seed', type=int, help='random seed for --record')
+    parser.add_argument('--replay', help='play a recorded session back without a window at full speed and print the result as JSON')
+    parser.add_argument('--load-report', help='measure loading of the whole level per layer and entity type on startup, print it, write it to this .json file and fail if a layer is over LOAD_BUDGETS')
+    parser.add_argument('--benchmark', help='measure update ticks/s, draw fps per resolution, setup time and peak memory on the level and its scaled-up copies and write them to this .json file')
+    parser.add_argument('--compare', help='with --benchmark: a stored benchmark .json, fail if a metric got worse by more than BENCHMARK_TOLERANCE')
+    parser.add_argument('--build-atlas', action='store_true', help='pack every sprite frame at its final size into ' + ATLAS_MANIFEST + ' and the atlas pages next to it')
+    args = parser.parse_args()
+
+    if args.build_atlas:
+        print(json.dumps(build_atlas(), ensure_ascii=False))
+    elif args.benchmark:
+        results = benchmark()
+        with open(args.benchmark, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(json.dumps(results, ensure_ascii=False))
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                regressions = compare_benchmark(results, json.load(f))
+            if regressions:
+                parser.exit(1, 'Regressions against ' + args.compare + ':\n' + '\n'.join(regressions) + '\n')
+    elif args.replay:
+        replay = Replay(args.replay)
+        game = Game(headless=True, batched_enemies=replay.batched_enemies, settings={'resolution': replay.resolution, 'view_mode': replay.view_mode}, load_report=args.load_report)
+        if args.profile:
+            game.profiler.open(args.profile)
+        print(json.dumps(game.replay(replay), ensure_ascii=False))
+    elif args.headless:
+        inputs = []
+        if args.inputs:
+            with open(args.inputs, encoding='utf-8') as f:
+                inputs = [[pg.key.key_code(name) for name in keys] for keys in json.load(f)]
+        game = Game(headless=True, batched_enemies=args.batched_enemies or BATCHED_ENEMIES, load_report=args.load_report)
+        if args.profile:
+            game.profiler.open(args.profile)
+        print(json.dumps(game.simulate(inputs, args.ticks), ensure_ascii=False))
+    else:
+        game = Game(batched_enemies=args.batched_enemies or BATCHED_ENEMIES, load_report=args.load_report)
+        if args.profile:
+            game.profiler.open(args.profile)
+        if args.record:
+            game.record(args.record, args.seed)
+        game.run()
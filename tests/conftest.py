@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Без окна и звука, ассеты и уровень main.py ищет относительно корня репозитория
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
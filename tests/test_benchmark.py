@@ -0,0 +1,44 @@
+import main
+
+
+def result(setup_ms=100, peak_kb=1000, ticks_per_second=2000, fps=None):
+    return {'setup_ms': setup_ms, 'peak_kb': peak_kb, 'ticks_per_second': ticks_per_second, 'fps': fps or {'900x600': 200, '250x250': 400}}
+
+
+def compare(current, baseline=None, tolerance=0.15):
+    return main.compare_benchmark({'maps': {'1x': current}}, {'maps': {'1x': baseline or result()}}, tolerance)
+
+
+def test_same_results_pass():
+    assert compare(result()) == []
+
+
+def test_within_tolerance_pass():
+    # Ровно на границе допуска - ещё не регрессия
+    assert compare(result(setup_ms=115, peak_kb=1150, ticks_per_second=1700, fps={'900x600': 170, '250x250': 340})) == []
+
+
+def test_slower_or_bigger_fail():
+    assert compare(result(setup_ms=116)) == ['1x setup_ms: 100.0 -> 116.0 (+16%)']
+    assert compare(result(peak_kb=1200)) == ['1x peak_kb: 1000.0 -> 1200.0 (+20%)']
+    assert compare(result(ticks_per_second=1600)) == ['1x ticks_per_second: 2000.0 -> 1600.0 (-20%)']
+    assert compare(result(fps={'900x600': 100, '250x250': 400})) == ['1x fps 900x600: 200.0 -> 100.0 (-50%)']
+
+
+def test_improvements_pass():
+    assert compare(result(setup_ms=10, peak_kb=10, ticks_per_second=20000, fps={'900x600': 2000, '250x250': 4000})) == []
+
+
+def test_tolerance_is_configurable():
+    assert compare(result(setup_ms=110), tolerance=0.05) == ['1x setup_ms: 100.0 -> 110.0 (+10%)']
+    assert compare(result(setup_ms=110), tolerance=0.2) == []
+
+
+def test_missing_maps_and_resolutions_are_skipped():
+    baseline = {'maps': {'1x': result(), '50x': result()}}
+    current = {'maps': {'1x': result(fps={'900x600': 200})}}
+    assert main.compare_benchmark(current, baseline) == []
+
+
+def test_zero_baseline_is_not_a_regression():
+    assert compare(result(setup_ms=5), result(setup_ms=0)) == []
@@ -0,0 +1,130 @@
+import math
+import random
+
+import pygame as pg
+import pytest
+
+import main
+
+TILE = 20
+
+
+class CellCollider:
+    # TileCollider до слияния прямоугольников: проверяет клетку за клеткой
+    def __init__(self, level, tile_size):
+        self.level = level
+        self.tile_size = tile_size
+
+    def solid(self, column, row):
+        level = self.level
+        return 0 <= column < level.width and 0 <= row < level.height and level.solid[row * level.width + column] == 1
+
+    def span(self, start, length):
+        return range(start // self.tile_size, (start + length - 1) // self.tile_size + 1)
+
+    def blocked(self, columns, rows):
+        return any(self.solid(column, row) for column in columns for row in rows)
+
+    def overlaps(self, rect):
+        return self.blocked(self.span(rect.x, rect.width), self.span(rect.y, rect.height))
+
+    def sweep_x(self, rect, dx):
+        size = self.tile_size
+        target = math.floor(rect.x + dx + 0.5)
+        rows = self.span(rect.y, rect.height)
+        if target > rect.x:
+            for column in range((rect.right - 1) // size + 1, (target + rect.width - 1) // size + 1):
+                if self.blocked((column,), rows):
+                    rect.right = column * size
+                    return True
+        elif target < rect.x:
+            for column in range(rect.left // size - 1, target // size - 1, -1):
+                if self.blocked((column,), rows):
+                    rect.left = (column + 1) * size
+                    return True
+        rect.x = target
+        return False
+
+    def sweep_y(self, rect, dy):
+        size = self.tile_size
+        target = math.floor(rect.y + dy + 0.5)
+        columns = self.span(rect.x, rect.width)
+        if target > rect.y:
+            for row in range((rect.bottom - 1) // size + 1, (target + rect.height - 1) // size + 1):
+                if self.blocked(columns, (row,)):
+                    rect.bottom = row * size
+                    return True
+        elif target < rect.y:
+            for row in range(rect.top // size - 1, target // size - 1, -1):
+                if self.blocked(columns, (row,)):
+                    rect.top = (row + 1) * size
+                    return True
+        rect.y = target
+        return False
+
+
+def random_level(seed, width=40, height=30, density=0.3):
+    rnd = random.Random(seed)
+    solid = bytes(rnd.random() < density for _ in range(width * height))
+    return main.Level(width, height, 8, 8, solid, {}, {})
+
+
+def coverage(level):
+    # Сколько раз каждая клетка покрыта прямоугольниками merge_solid
+    cover = [0] * (level.width * level.height)
+    rects = level.rects
+    for i in range(0, len(rects), 4):
+        x, y, width, height = rects[i:i + 4]
+        assert width > 0 and height > 0
+        for row in range(y, y + height):
+            for column in range(x, x + width):
+                cover[row * level.width + column] += 1
+    return cover
+
+
+@pytest.mark.parametrize('density', [0, 0.1, 0.5, 0.9, 1])
+def test_merge_solid_covers_solid_exactly(density):
+    for seed in range(5):
+        level = random_level(seed, density=density)
+        assert coverage(level) == list(level.solid)
+
+
+def test_merge_solid_merges_blocks():
+    solid = bytearray(6 * 4)
+    for row in range(1, 3):
+        for column in range(1, 5):
+            solid[row * 6 + column] = 1
+    level = main.Level(6, 4, 8, 8, bytes(solid), {}, {})
+    assert list(level.rects) == [1, 1, 4, 2]
+
+
+@pytest.mark.parametrize('chunk_tiles', [4, 16])
+def test_collider_matches_per_cell(chunk_tiles):
+    for seed in range(4):
+        level = random_level(seed, density=(0.05, 0.2, 0.5, 0.8)[seed])
+        merged, cells = main.TileCollider(level, TILE, chunk_tiles), CellCollider(level, TILE)
+        rnd = random.Random(seed)
+        for _ in range(3000):
+            rect = pg.Rect(rnd.randint(-60, level.width * TILE), rnd.randint(-60, level.height * TILE), rnd.randint(1, 70), rnd.randint(1, 70))
+            assert merged.overlaps(rect) == cells.overlaps(rect), rect
+            delta = rnd.uniform(-120, 120)
+            for sweep in ('sweep_x', 'sweep_y'):
+                a, b = rect.copy(), rect.copy()
+                assert getattr(merged, sweep)(a, delta) == getattr(cells, sweep)(b, delta), (sweep, rect, delta)
+                assert a == b, (sweep, rect, delta)
+
+
+def test_collider_on_shipped_level():
+    level = main.Game(headless=True).tmx_map
+    assert coverage(level) == list(level.solid)
+    size = int(level.tilewidth * main.TILE_SIZE)
+    merged, cells = main.TileCollider(level, size), CellCollider(level, size)
+    rnd = random.Random(0)
+    for _ in range(3000):
+        rect = pg.Rect(rnd.randint(-100, level.width * size), rnd.randint(-100, level.height * size), rnd.randint(1, 120), rnd.randint(1, 120))
+        assert merged.overlaps(rect) == cells.overlaps(rect), rect
+        delta = rnd.uniform(-150, 150)
+        a, b = rect.copy(), rect.copy()
+        assert (merged.sweep_x(a, delta), a) == (cells.sweep_x(b, delta), b), (rect, delta)
+        a, b = rect.copy(), rect.copy()
+        assert (merged.sweep_y(a, delta), a) == (cells.sweep_y(b, delta), b), (rect, delta)
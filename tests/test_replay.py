@@ -0,0 +1,81 @@
+import pygame as pg
+import pytest
+
+import main
+
+
+def play(game, ticks):
+    # Ходьба вправо с прыжками и выстрел через каждые 40 тиков, события идут и в запись
+    for tick in range(ticks):
+        if tick % 40 == 0:
+            event = pg.event.Event(pg.KEYDOWN, key=pg.K_e)
+            game.recorder.event(event)
+            game.handle_event(event)
+        keys = {pg.K_d} | ({pg.K_SPACE} if tick % 23 == 0 else set())
+        game.input_source = lambda keys=keys: main.KeyState(keys)
+        game.update()
+
+
+def test_records_round_trip(tmp_path):
+    path = tmp_path / 'run.bprp'
+    recorder = main.ReplayRecorder(path, 1234, 3, True, False)
+    recorder.event(pg.event.Event(pg.KEYDOWN, key=pg.K_p))
+    recorder.event(pg.event.Event(pg.KEYDOWN, key=main.PROFILER_KEY))  # профайлер не записывается
+    for _ in range(3):
+        recorder.tick(main.KeyState((pg.K_d,)))
+    recorder.event(pg.event.Event(pg.MOUSEBUTTONDOWN, pos=(10, 20), button=1))
+    for _ in range(0x10001):
+        recorder.tick(main.KeyState((pg.K_a, pg.K_SPACE)))
+    recorder.close(b'\x01' * 20)
+
+    replay = main.Replay(path)
+    assert (replay.seed, replay.resolution, replay.view_mode, replay.batched_enemies) == (1234, 3, True, False)
+    assert replay.digest == b'\x01' * 20
+    assert replay.ticks() == 3 + 0x10001
+    records = [([(event.type, event.dict) for event in events], count, [key for key in main.REPLAY_KEYS if keys[key]])
+               for events, count, keys in replay.records]
+    assert records == [
+        ([(pg.KEYDOWN, {'key': pg.K_p})], 3, [pg.K_d]),
+        ([(pg.MOUSEBUTTONDOWN, {'pos': (10, 20), 'button': 1})], 0xFFFF, [pg.K_a, pg.K_SPACE]),
+        ([], 2, [pg.K_a, pg.K_SPACE]),
+    ]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'run.bprp'
+    path.write_bytes(main.REPLAY_HEADER.pack(b'BPRP', main.REPLAY_VERSION + 1, 0, main.TICK_RATE, 0, 0))
+    with pytest.raises(ValueError):
+        main.Replay(path)
+    path.write_bytes(main.REPLAY_HEADER.pack(b'XXXX', main.REPLAY_VERSION, 0, main.TICK_RATE, 0, 0))
+    with pytest.raises(ValueError):
+        main.Replay(path)
+
+
+@pytest.mark.parametrize('batched_enemies', [False, pytest.param(True, marks=pytest.mark.skipif(main.np is None, reason='numpy is not installed'))])
+def test_replay_matches_recording(tmp_path, batched_enemies):
+    path = tmp_path / 'run.bprp'
+    game = main.Game(headless=True, batched_enemies=batched_enemies)
+    game.record(path, seed=7)
+    play(game, 600)
+    digest = game.state_digest()
+    game.recorder.close(digest)
+
+    replay = main.Replay(path)
+    game = main.Game(headless=True, batched_enemies=replay.batched_enemies)
+    result = game.replay(replay)
+    assert result['ticks'] == 600
+    assert result['digest'] == digest.hex()
+    assert result['matches']
+
+
+def test_digest_covers_entities():
+    game = main.Game(headless=True)
+    digest = game.state_digest()
+    assert game.state_digest() == digest
+
+    # state() сущности по отдельности не видит, а хеш должен
+    key, sprite = next((key, sprite) for key, sprite in game.streamed.items() if key[0] in ('bombs', 'worms'))
+    state = game.state()
+    sprite.rect.x += 1
+    assert game.state() == state
+    assert game.state_digest() != digest